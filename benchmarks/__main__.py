@@ -0,0 +1,198 @@
+import argparse
+import contextlib
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from .fixture import create_fixture
+from .scenarios import micro_scenarios, page_scenarios, request_scenarios
+
+# Boot the website against a Redis stand-in and a fixture Subsurface checkout and
+# measure latency (p50 / p99) and throughput of every route - content pages in every
+# language, update checks, the APIs, redirects, downloads and the webhook - plus a few
+# hot helper functions. Every run is a fresh process with a fresh fixture; a single run
+# against fakeredis is too noisy to compare, so the best p50 out of --runs runs (default
+# 3) is compared against a stored baseline:
+#     python -m benchmarks                     run everything, compare with benchmarks/baseline.json
+#     python -m benchmarks --quick             fewer iterations, for a quick look
+#     python -m benchmarks --save-baseline     store the results as the new baseline
+# By default Redis is fakeredis (pip install 'fakeredis[lua]'); set BENCH_REDIS_URL to
+# measure against a real server instead - that database gets flushed!
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+WEBHOOK_SECRET = "benchmark"
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def summarize(samples):
+    return {
+        "n": len(samples),
+        "p50_us": round(percentile(samples, 50) * 1e6, 1),
+        "p99_us": round(percentile(samples, 99) * 1e6, 1),
+        "per_second": round(len(samples) / sum(samples), 1) if sum(samples) else 0,
+    }
+
+
+@contextlib.contextmanager
+def quiet():
+    # the server (and git and make below it) is chatty - keep that out of the report
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+    try:
+        with open(os.devnull, "w") as f, contextlib.redirect_stdout(f):
+            yield
+    finally:
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        for fd in saved + [devnull]:
+            os.close(fd)
+
+
+def setup(root):
+    os.environ["DOWNLOADS_PATH"] = os.path.join(root, "downloads")
+    os.environ["webhook_secret"] = WEBHOOK_SECRET
+    os.environ.pop("DOWNLOADS_DELIVERY", None)
+    os.environ.pop("METRICS_TOKEN", None)
+
+    import src.web.redis
+
+    if os.environ.get("BENCH_REDIS_URL"):
+        from redis import Redis
+
+        src.web.redis.redis = Redis.from_url(os.environ["BENCH_REDIS_URL"])
+        src.web.redis.redis.flushdb()
+    else:
+        import fakeredis
+
+        src.web.redis.redis = fakeredis.FakeRedis()
+
+    from src.web.globals import globals
+
+    globals["app_path"] = root
+    globals["env_file_path"] = os.path.join(root, "persistent.store")
+
+    from src.web import server
+    from src.web.manuals import ManualManifest
+
+    create_fixture(root)
+    app = server.create_app()
+    # the fixture publishes the manuals below its own static directory
+    server.manual_manifest = ManualManifest(os.path.join(root, "src", "web", "static"))
+    globals["subsurfacesync"].sync()
+    globals["nightlybuilds"].sync()
+    return server, app
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    print(f"{'benchmark':45} {'n':>6} {'per sec':>10} {'p50 us':>10} {'p99 us':>10} {'baseline':>10} {'change':>8}")
+    for name, r in results.items():
+        base = baseline.get(name, {}).get("p50_us")
+        change = ""
+        if base:
+            ratio = r["p50_us"] / base - 1
+            change = f"{ratio:+.0%}"
+            if ratio > threshold:
+                regressions.append(name)
+                change += " !"
+        print(
+            f"{name:45} {r['n']:>6} {r['per_second']:>10} {r['p50_us']:>10} {r['p99_us']:>10} {base or '-':>10} {change:>8}"
+        )
+    return regressions
+
+
+def measure(quick: bool):
+    n, batches = (10, 20) if quick else (50, 100)
+    with tempfile.TemporaryDirectory(prefix="website-bench.") as root:
+        with quiet():
+            server, app = setup(root)
+            from src.web.env import env
+            from src.web.freeze import frozen_pages
+            from src.web.locales import languages
+
+            client = app.test_client()
+            raw = {}
+            raw.update(page_scenarios(client, frozen_pages(), languages, n // 5 or 1))
+            raw.update(request_scenarios(client, n * 4, WEBHOOK_SECRET))
+            raw.update(micro_scenarios(server, env, batches, 1000))
+    return {name: summarize(samples) for name, samples in sorted(raw.items())}
+
+
+def best_of(runs):
+    # for every benchmark the run with the lowest p50 - noise only ever makes things slower
+    best = {}
+    for results in runs:
+        for name, r in results.items():
+            if name not in best or r["p50_us"] < best[name]["p50_us"]:
+                best[name] = r
+    return best
+
+
+def run(quick: bool, runs: int):
+    # the server keeps module level state (like its Redis client), so every run needs its own process
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = []
+    for i in range(runs):
+        with tempfile.TemporaryDirectory(prefix="website-bench-results.") as out:
+            output = os.path.join(out, "results.json")
+            command = [sys.executable, "-m", "benchmarks", "--single-run", output] + (["--quick"] if quick else [])
+            subprocess.run(command, cwd=root, check=True)
+            with open(output, "r") as f:
+                results.append(json.load(f))
+        print(f"run {i + 1} of {runs} done")
+    return best_of(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the Subsurface website")
+    parser.add_argument("--quick", action="store_true", help="fewer iterations")
+    parser.add_argument("--runs", type=int, default=3, help="compare the best p50 out of this many runs")
+    parser.add_argument("--filter", default="", help="only report benchmarks whose name contains this")
+    parser.add_argument("--threshold", type=float, default=0.5, help="allowed p50 slowdown against the baseline")
+    parser.add_argument("--baseline", default=BASELINE, help="baseline file")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    # used by run() - measure once and write the results to the given file
+    parser.add_argument("--single-run", metavar="FILE", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.single_run:
+        with open(args.single_run, "w") as f:
+            json.dump(measure(args.quick), f)
+        return
+
+    started = time.monotonic()
+    results = {name: r for name, r in run(args.quick, max(1, args.runs)).items() if args.filter in name}
+
+    baseline = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline, args.threshold)
+    print(f"finished in {time.monotonic() - started:.0f} seconds")
+    if args.save_baseline:
+        if not args.filter:
+            # a complete run replaces the baseline, so benchmarks that are gone disappear from it
+            baseline = {}
+        with open(args.baseline, "w") as f:
+            json.dump({**baseline, **results}, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"saved the results as baseline in {args.baseline}")
+    elif regressions:
+        print(f"{len(regressions)} benchmarks got more than {args.threshold:.0%} slower than the baseline:")
+        for name in regressions:
+            print(f"    {name}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import os
+import subprocess
+
+# A small but realistic stand-in for the checkouts the server works with:
+# - subsurface/ with a Documentation/ tree whose Makefile just copies the sources
+#   (no asciidoctor needed) and a generated SupportedDivecomputers.html
+# - subsurface/nightly-builds cloned from a local repo with a branch-for-<sha>
+#   for every build, like the real nightly-builds repo
+# - downloads/ with a binary for the range requests
+FIRST_BUILD = 5000
+BUILDS = 200
+DOWNLOAD_SIZE = 8 * 1024 * 1024
+
+MAKEFILE = """output/%.html: %.txt $(wildcard images/*)
+\tmkdir -p output/images output/mobile-images
+\tcp -r images/. output/images/
+\tcp -r mobile-images/. output/mobile-images/
+\tcp $< $@
+"""
+
+
+def build_sha(bnr: int):
+    return f"{bnr:040x}"
+
+
+def _git(cwd, *args, input=None):
+    subprocess.run(
+        ["git", "-c", "user.email=bench@example.com", "-c", "user.name=bench", *args],
+        cwd=cwd,
+        input=input,
+        stdout=subprocess.DEVNULL,
+        check=True,
+    )
+
+
+def _write(path, content, mode="w"):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, mode) as f:
+        f.write(content)
+
+
+def _divecomputers():
+    vendors = []
+    for v in range(60):
+        models = ", ".join(
+            f"Model {v}-{m}" + (" (BLE)" if m % 3 == 0 else "") + (" (2012)" if m % 7 == 0 else "") for m in range(15)
+        )
+        vendors.append(f"<dt><a name='Vendor{v}'>Vendor {v}</a></dt><dd><p>{models}</p></dd>")
+    return "<dl>" + "\n".join(vendors) + "</dl>\n"
+
+
+def _nightly_builds(root):
+    # git fast-import creates all the branches in one go
+    upstream = os.path.join(root, "upstream", "nightly-builds")
+    os.makedirs(upstream)
+    _git(upstream, "init", "-q", "-b", "main")
+    stream = []
+    for i, bnr in enumerate(range(FIRST_BUILD, FIRST_BUILD + BUILDS)):
+        ref = "refs/heads/main" if i == 0 else f"refs/heads/branch-for-{build_sha(bnr)}"
+        content = f"{bnr}\n"
+        stream += [
+            f"commit {ref}",
+            f"mark :{i + 1}",
+            "committer bench <bench@example.com> 1700000000 +0000",
+            "data 6",
+            "build\n",
+        ]
+        if i:
+            stream.append("from :1")
+        stream += ["M 644 inline latest-subsurface-buildnumber", f"data {len(content)}", content]
+    _git(upstream, "fast-import", "--quiet", input="\n".join(stream).encode("utf-8"))
+    _git(upstream, "checkout", "-q", "main")
+    _git(os.path.join(root, "subsurface"), "clone", "-q", upstream, "nightly-builds")
+
+
+def create_fixture(root: str):
+    subsurface = os.path.join(root, "subsurface")
+    docs = os.path.join(subsurface, "Documentation")
+    for name in ("user-manual", "user-manual_de", "mobile-manual-v3", "mobile-manual_de"):
+        _write(os.path.join(docs, f"{name}.txt"), f"<html><body>{name}" + " lorem ipsum" * 20000 + "</body></html>\n")
+    for i in range(20):
+        _write(os.path.join(docs, "images", f"image{i}.png"), os.urandom(20000), "wb")
+        _write(os.path.join(docs, "mobile-images", f"image{i}.png"), os.urandom(20000), "wb")
+    _write(os.path.join(docs, "Makefile"), MAKEFILE)
+    _write(os.path.join(subsurface, "SupportedDivecomputers.html"), _divecomputers())
+    _git(subsurface, "init", "-q", "-b", "main")
+    _git(subsurface, "add", ".")
+    _git(subsurface, "commit", "-q", "-m", "fixture")
+    _nightly_builds(root)
+    os.makedirs(os.path.join(root, "src", "web", "templates"))
+    os.makedirs(os.path.join(root, "src", "web", "static"))
+    _write(os.path.join(root, "downloads", f"Subsurface-6.0.{FIRST_BUILD}-CICD-release.dmg"), os.urandom(DOWNLOAD_SIZE), "wb")
@@ -0,0 +1,208 @@
+import hashlib
+import hmac
+import itertools
+import json
+import time
+
+from .fixture import BUILDS, DOWNLOAD_SIZE, FIRST_BUILD, build_sha
+
+# What clients actually send to the update check: mostly recent releases, some
+# older ones, local builds, the odd 4 part version of very old releases and garbage
+VERSION_MIX = (
+    ["6.0.5214"] * 30
+    + ["6.0.5214-CICD-release"] * 20
+    + ["6.0.5100", "6.0.5000", "5.0.10", "5.0.2", "4.9.10"] * 4
+    + ["6.0.5214-local", "6.0.5220-CICD-release", "6.0.5300"] * 3
+    + ["4.8.6.1", "4.7.8.0"] * 2
+    + ["", "not-a-version"]
+)
+OPERATING_SYSTEMS = ["win", "mac", "linux", "android", "ios"]
+ACCEPT_LANGUAGES = [
+    "en-US,en;q=0.9",
+    "de-DE,de;q=0.9,en-US;q=0.8,en;q=0.7",
+    "fr-FR,fr;q=0.9",
+    "pt-BR,pt;q=0.9,en;q=0.8",
+    "zh-CN,zh;q=0.9",
+    "",
+]
+LANGUAGE_CODES = ["de", "DE", "de-de", "de_DE", "pt-br", "pt", "en", "en-US", "zz", "", "sv_SE", "fr-CA"]
+
+
+def timed(fn, n: int, warmup: int):
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(n):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def batched(fn, batches: int, size: int):
+    # for things that take microseconds: time batches and report the time per call
+    fn()
+    samples = []
+    for _ in range(batches):
+        start = time.perf_counter()
+        for _ in range(size):
+            fn()
+        samples.append((time.perf_counter() - start) / size)
+    return samples
+
+
+def cycling_request(client, requests, expected):
+    # returns a function that sends the next of the given requests each time it is called
+    requests = itertools.cycle(requests)
+
+    def send():
+        method, path, kwargs = next(requests)
+        response = client.open(path, method=method, **kwargs)
+        response.get_data()
+        if response.status_code not in expected:
+            raise RuntimeError(f"{method} {path}: unexpected status {response.status_code}")
+        # every redirect has to stay on this site
+        location = response.headers.get("Location", "/")
+        if not location.startswith("/") or location.startswith(("//", "/\\")):
+            raise RuntimeError(f"{method} {path}: redirects to {location}")
+        response.close()
+
+    return send
+
+
+def page_scenarios(client, pages, languages, n):
+    # every content page in every language - the first request renders the page,
+    # the rest are served from the page cache
+    results = {}
+    for lang in languages:
+        # the test client ignores a Cookie header - the language has to go into its cookie jar
+        client.set_cookie("lang", lang)
+        for rule in pages:
+            send = cycling_request(client, [("GET", rule, {})], (200,))
+            results.setdefault(f"page cold {rule}", []).extend(timed(send, 1, 0))
+            samples = timed(send, n, 0)
+            results.setdefault(f"page {rule}", []).extend(samples)
+            results.setdefault(f"lang {lang}", []).extend(samples)
+    client.delete_cookie("lang")
+    return results
+
+
+def request_scenarios(client, n, webhook_secret):
+    known_sha = build_sha(FIRST_BUILD + BUILDS // 2)
+    known_bnr = FIRST_BUILD + BUILDS // 2
+    updatechecks = [
+        {"query_string": {"version": v, "os": os_name}} for v, os_name in zip(VERSION_MIX, itertools.cycle(OPERATING_SYSTEMS))
+    ]
+    scenarios = {
+        "updatecheck legacy": ([("GET", "/updatecheck.html", kw) for kw in updatechecks], (200,)),
+        "updatecheck2": ([("GET", "/updatecheck2/", kw) for kw in updatechecks], (200, 400)),
+        "api build-nr-by-sha hit": ([("GET", f"/api/build-nr-by-sha/{known_sha}", {})], (200,)),
+        "api build-nr-by-sha miss": ([("GET", f"/api/build-nr-by-sha/{'f' * 40}", {})], (200,)),
+        "api sha-by-build-nr hit": ([("GET", f"/api/sha-by-build-nr/{known_bnr}", {})], (200,)),
+        "api sha-by-build-nr miss": ([("GET", "/api/sha-by-build-nr/999999", {})], (200,)),
+        "api builds batch hit": (
+            [
+                (
+                    "POST",
+                    "/api/builds",
+                    {
+                        "json": {
+                            "shas": [build_sha(FIRST_BUILD + i) for i in range(1, 40)],
+                            "build_nrs": list(range(FIRST_BUILD + 1, FIRST_BUILD + 40)),
+                        }
+                    },
+                )
+            ],
+            (200,),
+        ),
+        # one unknown SHA and build number - after the first pull these come from the negative cache
+        "api builds batch miss": (
+            [
+                (
+                    "POST",
+                    "/api/builds",
+                    {
+                        "json": {
+                            "shas": [build_sha(FIRST_BUILD + i) for i in range(1, 20)] + ["f" * 40],
+                            "build_nrs": list(range(FIRST_BUILD + 1, FIRST_BUILD + 20)) + [999999],
+                        }
+                    },
+                )
+            ],
+            (200,),
+        ),
+        "api divecomputers search": (
+            [("GET", "/api/divecomputers", {"query_string": {"q": q}}) for q in ("vendor 1", "model 3-1", "ble", "zz")],
+            (200,),
+        ),
+        "redirect language": (
+            [("GET", p, {}) for p in ("/de/faq/", "/fr_FR/", "/pt_BR/downloads/x?lang=de", "/de//example.com")],
+            (302,),
+        ),
+        "redirect misc": (
+            [("GET", p, {}) for p in ("/misc/faq/", "/documentation/user-manual/", "/misc//example.com/x")],
+            (301,),
+        ),
+        "downloads range start": (
+            [("GET", f"/downloads/Subsurface-6.0.{FIRST_BUILD}-CICD-release.dmg", {"headers": {"Range": "bytes=0-65535"}})],
+            (206,),
+        ),
+        "downloads range middle": (
+            [
+                (
+                    "GET",
+                    f"/downloads/Subsurface-6.0.{FIRST_BUILD}-CICD-release.dmg",
+                    {"headers": {"Range": f"bytes={DOWNLOAD_SIZE // 2}-{DOWNLOAD_SIZE // 2 + 1048575}"}},
+                )
+            ],
+            (206,),
+        ),
+        "manual br": ([("GET", "/subsurface-user-manual/", {"headers": {"Accept-Encoding": "gzip, br"}})], (200,)),
+    }
+    results = {}
+    for name, (requests, expected) in scenarios.items():
+        results[name] = timed(cycling_request(client, requests, expected), n, min(n, 20))
+
+    body = json.dumps({"action": "published", "release": {"id": 1}}).encode("utf-8")
+    signature = "sha256=" + hmac.new(webhook_secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+    deliveries = itertools.count()
+
+    def webhook(valid):
+        def send():
+            headers = {
+                "X-Hub-Signature-256": signature if valid else "sha256=" + "0" * 64,
+                "X-GitHub-Delivery": f"bench-{next(deliveries)}",
+            }
+            response = client.post("/subsurface-release-webhook", data=body, headers=headers)
+            if response.status_code != (202 if valid else 403):
+                raise RuntimeError(f"webhook: unexpected status {response.status_code}")
+
+        return send
+
+    results["webhook valid"] = timed(webhook(True), n, min(n, 20))
+    results["webhook bad signature"] = timed(webhook(False), n, min(n, 20))
+    return results
+
+
+def micro_scenarios(server, env, batches, size):
+    from semver.version import Version
+
+    from src.web.env import pin_snapshot, unpin_snapshot
+    from src.web.locales import resolve_accept_language, resolve_language
+
+    codes = itertools.cycle(LANGUAGE_CODES)
+    headers = itertools.cycle(ACCEPT_LANGUAGES)
+    current = Version.parse("6.0.5214")
+    versions = itertools.cycle([v for v in map(server._parse_version, VERSION_MIX) if v is not None])
+    results = {
+        "micro resolve_language": batched(lambda: resolve_language(next(codes)), batches, size),
+        "micro resolve_accept_language": batched(lambda: resolve_accept_language(next(headers)), batches, size),
+        "micro version_check": batched(lambda: server.version_check(current, next(versions)), batches, size),
+        "micro Env.value": batched(lambda: env["crelease"].value, batches, size),
+    }
+    pin_snapshot()
+    try:
+        results["micro Env.value pinned"] = batched(lambda: env["release_ids"].value, batches, size)
+    finally:
+        unpin_snapshot()
+    return results
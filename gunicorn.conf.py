@@ -0,0 +1,18 @@
+# load (and warm up) the app once in the master and fork the workers from it,
+# so they share the compiled templates and translation catalogs
+wsgi_app = "src.web.server:create_app()"
+preload_app = True
+workers = 4
+bind = "0.0.0.0:8001"
+
+
+def post_worker_init(worker):
+    from src.web.maintenance import init_worker
+
+    init_worker()
+
+
+def worker_exit(server, worker):
+    from src.web.maintenance import exit_worker
+
+    exit_worker()
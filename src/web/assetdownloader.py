@@ -1,84 +1,53 @@
 import datetime
-import os
 import re
-import requests
 import sys
 from dotenv import load_dotenv
-from github import Auth, Github
-from threading import Timer
 
-from .env import env
+from .env import batch, env
+from .freeze import schedule_freeze
+from .githubapi import github
 from .globals import globals
-
-if not globals["testrun"]:
-    from .redis import redis
-
-
-class Background:
-    def __init__(self, delay, function):
-        self._timer = None
-        self._delay = delay
-        self._function = function
-        self._running = False
-        self.schedule()
-
-    def schedule(self):
-        if not self._running:
-            self._running = True
-            self._timer = Timer(self._delay, self._run)
-            self._timer.start()
-
-    def _run(self):
-        # immediately schedule the next instance
-        self._running = False
-        # we don't want these to be recurring: self.schedule()
-        self._function()
-
-    def cancel(self):
-        if self._timer:
-            self._timer.cancel()
-        self._running = False
-
-
-class AssetDownloader:
-    def __init__(self, release_id, delay):
-        lock_name = f"processing_{release_id}"
-        if redis.set(lock_name, "1", nx=True):
-            self._release_id = release_id
-            self._bg = Background(delay, self._downloadAssets)
-            print(f"setting up to update the assets for release id {release_id} in {delay/60} minutes")
-
-    def _downloadAssets(self):
-        updateReleaseWebsite(self._release_id)
-
-
-def get_pr_title(bn: int):
-    r = requests.get(
-        f"https://github.com/subsurface/nightly-builds/releases/download/v6.0.{bn}-CICD-release/release_content_title.txt"
-    )
-    if r.status_code == 200:
-        print(f"finished build number {bn}, got PR title {r.content.decode()}")
-        return r.content.decode()
-    print(f"no PR title for build number {bn}")
-    return ""
-
-
-checked_releases = set()
-
-
+from .jobqueue import DONE, FAILED, RETRY, jobs
+from .prtitles import get_pr_titles
+
+# checking a release is a job in the persistent job queue: GitHub creates the release
+# before the binaries are uploaded, so keep checking (with growing intervals) until
+# all of them are there
+RELEASE_CHECK_BACKOFF = 150
+RELEASE_CHECK_MAX_BACKOFF = 30 * 60
+RELEASE_CHECK_ATTEMPTS = 12
+
+
+def schedule_release_check(release_id, delay):
+    if jobs.schedule(
+        f"release_{release_id}",
+        "release",
+        {"release_id": release_id},
+        delay=delay,
+        max_attempts=RELEASE_CHECK_ATTEMPTS,
+        backoff=RELEASE_CHECK_BACKOFF,
+        max_backoff=RELEASE_CHECK_MAX_BACKOFF,
+    ):
+        print(f"setting up to update the assets for release id {release_id} in {delay/60} minutes")
+
+
+def release_check(release_id, attempt):
+    status = updateReleaseWebsite(release_id)
+    if status == "done":
+        return DONE
+    if status == "not found" and attempt > 1:
+        print(f"giving up on release {release_id}")
+        return FAILED
+    return RETRY
+
+
+# returns "done" once the website shows the release, "incomplete" while binaries are
+# still missing and "not found" if GitHub doesn't know the release
 def updateReleaseWebsite(release_id):
-    auth = Auth.Token(os.environ.get("github_token", "").strip())
-    gh = Github(auth=auth)
-    repo = gh.get_repo("subsurface/nightly-builds")
     print(f"updateReleaseWebsite for release {release_id}")
-    found = False
-    releases = repo.get_releases()
-    for r in releases:
-        if r.id != release_id:
-            # print(f"checked release {r.id}")
-            continue
+    r = github.release(release_id)
+    if r is not None:
         print(f"found release {release_id}")
-        found = True
         macosurl = ""
         windowsurl = ""
         appimageurl = ""
@@ -87,8 +56,8 @@ def updateReleaseWebsite(release_id):
         apkname = ""
         apkurl = ""
         missing = ""
-        for a in r.get_assets():
-            url = a.browser_download_url
+        for a in r.get("assets", []):
+            url = a["browser_download_url"]
             print(f"{url}")
             match = re.search("Subsurface-mobile-6.*-CICD-release.apk", url)
             if match:
@@ -113,34 +82,31 @@ def updateReleaseWebsite(release_id):
             missing += " Linux AppImage,"
         if missing == "" and version != "":
             # only update the website once the releases is complete
-            # the three step update for release_ids is needed since we copy values in the Env class
             print("found all binaries, updating the website")
-            release_ids = env["release_ids"].value
-            if release_id in release_ids:
-                release_ids.remove(release_id)
-                env["release_ids"].value = release_ids
-            env["lrelease_date"].value = datetime.datetime.today().strftime("%Y-%m-%d")
-            env["lrelease"].value = version
-            # finally assemble the last 5 PR titles
+            # assemble the last 5 PR titles first, so that all values change at once
             current = version.split(".")
             pr_titles = ""
             if len(current) == 3:
-                buildnr = int(current[2])
-                for bn in range(buildnr, buildnr - 5, -1):
-                    pr_title = get_pr_title(bn)
-                    if pr_title:
-                        pr_titles += "<li>" + pr_title + "</li>"
-            env["pr_summary"].value = pr_titles
-        else:
-            print(f"Still missing {missing[:-1]} - scheduling myself to check again")
-            a = AssetDownloader(release_id, 150)
-    if not found:
-        if release_id not in checked_releases:
-            checked_releases.add(release_id)
-            print(f"very odd - didn't find {release_id}... rescheduling to try again")
-            a = AssetDownloader(release_id, 150)
-        else:
-            print(f"giving up on release {release_id}")
+                buildnrs = list(range(int(current[2]), int(current[2]) - 5, -1))
+                titles = get_pr_titles(buildnrs)
+                for bn in buildnrs:
+                    if titles[bn]:
+                        pr_titles += "<li>" + titles[bn] + "</li>"
+            with batch():
+                env["release_ids"].remove(release_id)
+                env["lrelease_date"].value = datetime.datetime.today().strftime("%Y-%m-%d")
+                env["lrelease"].value = version
+                env["pr_summary"].value = pr_titles
+            if globals["app"] is not None:
+                schedule_freeze()
+            return "done"
+        print(f"Still missing {missing[:-1]} - check again later")
+        return "incomplete"
+    print(f"very odd - didn't find {release_id}")
+    return "not found"
+
+
+jobs.register("release", release_check)
 
 
 if __name__ == "__main__":
@@ -151,4 +117,4 @@ if __name__ == "__main__":
     load_dotenv()
     release_id = int(sys.argv[1])
     print(f"updating website for release with release_id {release_id}")
-    updateReleaseWebsite(release_id=release_id)
+    print(updateReleaseWebsite(release_id=release_id))
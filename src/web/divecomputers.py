@@ -0,0 +1,164 @@
+import json
+import re
+from bisect import bisect_left
+from html.parser import HTMLParser
+
+from .env import generation
+from .redis import redis
+
+# SupportedDivecomputers.html (generated in the Subsurface repo) lists the models of
+# every vendor as <dt>vendor</dt><dd>model, model, ...</dd>. When the sync picks up a
+# new copy, it is parsed once into a list of (vendor, model, transports) entries,
+# together with an inverted index (word -> entries) and a sorted list of names for
+# prefix lookups, and the result is stored in Redis. Every worker loads it again
+# only when the Env generation changes.
+INDEX_KEY = "divecomputer_index"
+
+# transports are only known where the list marks a model with them, like "Perdix (BLE)"
+TRANSPORTS = {"bt": "bluetooth", "bluetooth": "bluetooth", "ble": "ble", "usb": "usb", "irda": "irda", "serial": "serial"}
+
+
+class _ListParser(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.vendors = []
+        self._tag = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "dt":
+            self.vendors.append(["", ""])
+            self._tag = tag
+        elif tag == "dd" and self.vendors:
+            self._tag = tag
+
+    def handle_endtag(self, tag):
+        if tag in ("dt", "dd"):
+            self._tag = None
+
+    def handle_data(self, data):
+        if self._tag == "dt":
+            self.vendors[-1][0] += data
+        elif self._tag == "dd":
+            self.vendors[-1][1] += data
+
+
+def _model(text):
+    transports = []
+    for marker in re.findall(r"\(([^)]*)\)", text):
+        words = [w.strip().lower() for w in marker.split(",")]
+        if words and all(w in TRANSPORTS for w in words):
+            transports += [TRANSPORTS[w] for w in words]
+            text = text.replace(f"({marker})", "")
+    return " ".join(text.split()), sorted(set(transports))
+
+
+def _words(text):
+    return re.findall(r"[a-z0-9]+", text.lower())
+
+
+def parse_supported_divecomputers(html: str):
+    # returns {vendor: [(model, transports), ...]}
+    parser = _ListParser()
+    parser.feed(html)
+    vendors = {}
+    for vendor, models in parser.vendors:
+        vendor = " ".join(vendor.split())
+        if not vendor:
+            continue
+        # split at commas that aren't inside parentheses
+        names = re.split(r",\s*(?![^()]*\))", models)
+        vendors.setdefault(vendor, []).extend(_model(n) for n in names if n.strip())
+    return vendors
+
+
+def build_index(vendors: dict):
+    entries = []
+    postings = {}
+    names = []
+    for vendor, models in vendors.items():
+        names.append((vendor.lower(), vendor))
+        for model, transports in models:
+            idx = len(entries)
+            entries.append([vendor, model, transports])
+            names.append((f"{vendor} {model}".lower(), f"{vendor} {model}"))
+            for word in set(_words(vendor) + _words(model)):
+                postings.setdefault(word, []).append(idx)
+    return {
+        "entries": entries,
+        "words": sorted(postings),
+        "postings": postings,
+        "names": sorted(set(names)),
+        "vendors": {vendor: len(models) for vendor, models in vendors.items()},
+    }
+
+
+def update_index(html_file: str):
+    with open(html_file, "r", encoding="utf-8") as f:
+        index = build_index(parse_supported_divecomputers(f.read()))
+    redis.set(INDEX_KEY, json.dumps(index))
+    print(f"indexed {len(index['entries'])} dive computers from {len(index['vendors'])} vendors")
+
+
+def index_exists():
+    return redis.exists(INDEX_KEY)
+
+
+def _prefix_range(sorted_list, prefix, key=lambda x: x):
+    # all items of the sorted list that start with prefix
+    start = bisect_left(sorted_list, prefix, key=key)
+    end = start
+    while end < len(sorted_list) and key(sorted_list[end]).startswith(prefix):
+        end += 1
+    return sorted_list[start:end]
+
+
+class DiveComputerIndex:
+    def __init__(self):
+        self._generation = None
+        self._index = None
+
+    def _current(self):
+        gen = generation()
+        if gen != self._generation:
+            value = redis.get(INDEX_KEY)
+            self._index = json.loads(value) if value else build_index({})
+            self._generation = gen
+        return self._index
+
+    def vendors(self):
+        return self._current()["vendors"]
+
+    def _results(self, ids, transport=None):
+        entries = self._current()["entries"]
+        results = []
+        for i in sorted(ids):
+            vendor, model, transports = entries[i]
+            if transport and transport not in transports:
+                continue
+            results.append({"vendor": vendor, "model": model, "transports": transports})
+        return results
+
+    def vendor(self, vendor: str, transport: str = None):
+        index = self._current()
+        ids = [i for i, entry in enumerate(index["entries"]) if entry[0] == vendor]
+        return self._results(ids, transport)
+
+    def search(self, query: str, transport: str = None):
+        # every word of the query has to match the beginning of a word of vendor or model
+        index = self._current()
+        ids = None
+        for word in _words(query):
+            matches = set()
+            for w in _prefix_range(index["words"], word):
+                matches.update(index["postings"][w])
+            ids = matches if ids is None else ids & matches
+            if not ids:
+                return []
+        return self._results(ids or [], transport)
+
+    def complete(self, prefix: str, limit: int = 20):
+        names = self._current()["names"]
+        return [name for _, name in _prefix_range(names, prefix.lower(), key=lambda n: n[0])[:limit]]
+
+
+dive_computers = DiveComputerIndex()
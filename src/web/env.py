@@ -1,24 +1,283 @@
+import copy
+import fcntl
 import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
 from os import path
 from .globals import globals
 from .redis import redis
 
 
+# every change to an Env value bumps a shared generation counter; anything
+# derived from Env values (like the rendered page cache) includes the generation
+# in its key and is therefore invalidated automatically across all workers
+GENERATION_KEY = "env_generation"
+
+
+def bump_generation():
+    return redis.incr(name=GENERATION_KEY)
+
+
+# Every change to an Env is a single script run in Redis, which also bumps the
+# generation (unless we are in a batch) - so no other worker can slip in between.
+# Values are stored as JSON strings, sets as Redis sets of JSON encoded members and
+# hashes as Redis hashes of JSON encoded values; adding to or removing from a set or
+# a hash only touches those members instead of rewriting the whole value. Writing
+# what is already there isn't a change - so starting a process doesn't invalidate
+# every worker's cache. Returns the number of changes.
+_update = redis.register_script(
+    """
+local op = ARGV[1]
+local changed = 0
+local kind = redis.call("TYPE", KEYS[1]).ok
+if op == "set" then
+    if kind ~= "string" or redis.call("GET", KEYS[1]) ~= ARGV[3] then
+        redis.call("SET", KEYS[1], ARGV[3])
+        changed = 1
+    end
+elseif op == "cas" then
+    if redis.call("GET", KEYS[1]) == ARGV[3] then
+        redis.call("SET", KEYS[1], ARGV[4])
+        changed = 1
+    end
+elseif op == "sadd" or op == "srem" or op == "hdel" then
+    for i = 3, #ARGV do
+        changed = changed + redis.call(string.upper(op), KEYS[1], ARGV[i])
+    end
+elseif op == "hset" then
+    for i = 3, #ARGV, 2 do
+        if redis.call("HGET", KEYS[1], ARGV[i]) ~= ARGV[i + 1] then
+            redis.call("HSET", KEYS[1], ARGV[i], ARGV[i + 1])
+            changed = changed + 1
+        end
+    end
+elseif op == "sreplace" or op == "hreplace" then
+    -- replacing a set or hash with what it already holds is no change
+    local same
+    if op == "sreplace" then
+        same = (kind == "none" and #ARGV == 2) or (kind == "set" and redis.call("SCARD", KEYS[1]) == #ARGV - 2)
+        for i = 3, #ARGV do
+            same = same and redis.call("SISMEMBER", KEYS[1], ARGV[i]) == 1
+        end
+    else
+        same = (kind == "none" and #ARGV == 2) or (kind == "hash" and redis.call("HLEN", KEYS[1]) * 2 == #ARGV - 2)
+        for i = 3, #ARGV, 2 do
+            same = same and redis.call("HGET", KEYS[1], ARGV[i]) == ARGV[i + 1]
+        end
+    end
+    if not same then
+        redis.call("DEL", KEYS[1])
+        if #ARGV > 2 then
+            redis.call(op == "sreplace" and "SADD" or "HSET", KEYS[1], unpack(ARGV, 3))
+        end
+        changed = 1
+    end
+end
+if changed > 0 and ARGV[2] == "1" then
+    redis.call("INCR", KEYS[2])
+end
+return changed
+"""
+)
+
+
+def _run_update(name, op, *args):
+    in_batch = getattr(_local, "pending", None) is not None
+    changed = _update(keys=[name, GENERATION_KEY], args=[op, "0" if in_batch else "1", *args])
+    if changed and in_batch:
+        _local.dirty = True
+    return changed
+
+
+# each worker keeps a snapshot of all Env values; it is only reloaded (with a
+# single MGET) when the shared generation has moved on. During a request the
+# snapshot is pinned, so a page render costs at most one generation check no
+# matter how many times the templates call get_env()
+_snapshot = {"generation": None, "values": {}}
+_local = threading.local()
+
+
+def _loads(v):
+    if v is None:
+        return None
+    try:
+        return json.loads(v)
+    except json.JSONDecodeError:
+        return None
+
+
+def _decode(kind, raw):
+    if isinstance(raw, Exception):
+        # most likely a key of the wrong type - Env() replaces it
+        return None
+    if kind == "set":
+        return _sorted_members(_loads(m) for m in raw)
+    if kind == "hash":
+        return {k.decode("utf-8"): _loads(v) for k, v in raw.items()}
+    return _loads(raw)
+
+
+def _sorted_members(members):
+    # sets are handed out as lists without duplicates, in a stable order
+    return sorted({json.dumps(m): m for m in members}.values(), key=json.dumps)
+
+
+def _read_commands(pipe, name, kind):
+    if kind == "set":
+        pipe.smembers(name)
+    elif kind == "hash":
+        pipe.hgetall(name)
+    else:
+        pipe.get(name)
+
+
+def _refresh_snapshot():
+    global _snapshot
+    gen = redis.get(name=GENERATION_KEY)
+    if gen is None or gen != _snapshot["generation"]:
+        # plain values, sets and hashes all in one round trip
+        names = list(Env.names)
+        pipe = redis.pipeline(transaction=False)
+        for name in names:
+            _read_commands(pipe, name, Env.kinds[name])
+        raw = pipe.execute(raise_on_error=False) if names else []
+        _snapshot = {"generation": gen, "values": {n: _decode(Env.kinds[n], r) for n, r in zip(names, raw)}}
+    return _snapshot
+
+
+def snapshot():
+    pinned = getattr(_local, "snapshot", None)
+    return pinned if pinned is not None else _refresh_snapshot()
+
+
+def pin_snapshot():
+    _local.snapshot = _refresh_snapshot()
+
+
+def unpin_snapshot():
+    _local.snapshot = None
+
+
+def generation():
+    gen = snapshot()["generation"]
+    return int(gen) if gen is not None else 0
+
+
+# The flat file is shared by all workers (and edited by make-current.sh), so
+# every write happens under an exclusive lock, re-reads the current content and
+# replaces the file atomically through a temp file and a rename. Reads are served
+# from a parsed copy that is only refreshed when the file changes on disk.
+class EnvFile:
+    def __init__(self, file_path: str):
+        self._path = file_path
+        self._stamp = None
+        self._values = {}
+
+    def _parse(self):
+        try:
+            st = os.stat(self._path)
+        except FileNotFoundError:
+            self._stamp = None
+            self._values = {}
+            return self._values
+        stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if stamp == self._stamp:
+            return self._values
+        values = {}
+        with open(self._path, "r") as f:
+            for line in f:
+                if line.strip().startswith("#"):
+                    continue
+                key, var = line.partition("=")[::2]
+                if not key.strip():
+                    continue
+                try:
+                    values[key.strip()] = json.loads(var)
+                except json.JSONDecodeError:
+                    pass
+        self._stamp = stamp
+        self._values = values
+        return values
+
+    def values(self):
+        return self._parse()
+
+    def update(self, updates: dict):
+        # a value can also be a function, which is called under the lock - that way
+        # whoever writes last also writes the latest state
+        directory = path.dirname(self._path) or "."
+        with open(f"{self._path}.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            values = dict(self._parse())
+            values.update({k: v() if callable(v) else v for k, v in updates.items()})
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".persistent.")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    for key, value in values.items():
+                        if key:
+                            f.write(f"{key}={json.dumps(value)}\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.chmod(tmp_path, 0o644)
+                os.replace(tmp_path, self._path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            dir_fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+            self._parse()
+
+
+# apply several Env updates as one: the file is written (and fsynced) once and the
+# generation is bumped once, so no worker ever caches a page with half the updates
+@contextmanager
+def batch():
+    if getattr(_local, "pending", None) is not None:
+        # nested batch - the outermost one writes everything
+        yield
+        return
+    _local.pending = {}
+    _local.dirty = False
+    try:
+        yield
+    finally:
+        pending, dirty = _local.pending, _local.dirty
+        _local.pending = None
+        _local.dirty = False
+        if pending:
+            env_file.update(pending)
+        if dirty:
+            bump_generation()
+
+
 # The Env class uses both a flat file and Redis to store values
 # This ensures that we stay consistent across the different workers,
 # but also have a file storage backend across unexpected reboots or
 # other issues that might prevent Redis from staying consistent across
 # restarts.
+# kind is "value" (anything JSON can store), "set" (a list without duplicates, with
+# atomic add() / remove()) or "hash" (a dict, with atomic set_item() / remove_item()).
+# In the flat file sets are stored as lists and hashes as objects.
 class Env:
+    names = []
+    kinds = {}
+
     def __init__(
         self,
         name: str,
         default: any = None,
+        kind: str = "value",
     ):
-        # Let's make sure we have an env file
-        if not path.isfile(globals.get("env_file_path")):
-            open(globals.get("env_file_path"), "w").close()
         self._name = name
+        self._kind = kind
+        if name not in Env.names:
+            Env.names.append(name)
+        Env.kinds[name] = kind
         # check if we have a value in backing store, otherwise use the default
         # if redis.get(name=self._name) == None:
         # get the value from the file and write either that or the default to Redis
@@ -27,35 +286,20 @@ class Env:
             self.value = value_in_file
         else:
             self.value = default
-        redis.set(name=self._name, value=json.dumps(self.value))
-
-    def _get_values_from_file(self):
-        ret = {}
-        try:
-            with open(globals.get("env_file_path"), "r") as f:
-                for line in f.readlines():
-                    if line.strip().startswith("#"):
-                        continue
-                    key, var = line.partition("=")[::2]
-                    if key is not None and var is not None:
-                        ret[key.strip()] = json.loads(var)
-        except (json.JSONDecodeError, FileNotFoundError):
-            pass
-
-        return ret
+        # this also converts keys of the wrong type (like a set that used to be a value)
+        self._store(self.value)
 
     def _get_value_from_file(self):
-        return self._get_values_from_file().get(self._name, None)
+        return env_file.values().get(self._name, None)
 
     def _write_value_to_file(self, new_value):
         if (self._name == "lrelease" or self._name == "crelease") and new_value == "":
             return
-        values = self._get_values_from_file()
-        values[self._name] = new_value
-        with open(globals.get("env_file_path"), "w") as f:
-            for key, value in values.items():
-                if key:
-                    f.write(f"{key}={json.dumps(value)}\n")
+        pending = getattr(_local, "pending", None)
+        if pending is not None:
+            pending[self._name] = new_value
+        else:
+            env_file.update({self._name: new_value})
 
     def __str__(self):
         return f"Env({self._name}, {self.value})"
@@ -64,21 +308,42 @@ class Env:
     def name(self):
         return self._name
 
+    def _normalize(self, value):
+        if self._kind == "set":
+            return _sorted_members(value or [])
+        if self._kind == "hash":
+            return dict(value or {})
+        return value
+
+    def _read(self):
+        # the current value straight from Redis
+        pipe = redis.pipeline(transaction=False)
+        _read_commands(pipe, self._name, self._kind)
+        return _decode(self._kind, pipe.execute(raise_on_error=False)[0])
+
+    def _store(self, value):
+        if self._kind == "set":
+            _run_update(self._name, "sreplace", *[json.dumps(m) for m in value])
+        elif self._kind == "hash":
+            _run_update(self._name, "hreplace", *[x for k, v in value.items() for x in (k, json.dumps(v))])
+        else:
+            _run_update(self._name, "set", json.dumps(value))
+
     @property
     def value(self):
-        v = redis.get(name=self._name)
-        result = None
-        if v is not None:
-            try:
-                result = json.loads(v)
-            except json.JSONDecodeError:
-                pass
-        return result
+        values = snapshot()["values"]
+        if self._name not in values:
+            # an Env created after the snapshot was taken
+            values[self._name] = self._read()
+        # hand out copies of lists and dicts so callers can't modify the snapshot
+        return copy.deepcopy(values[self._name])
 
     @value.setter
     def value(self, value):
+        value = self._normalize(value)
         if value != self.value:
-            redis.set(name=self._name, value=json.dumps(value))
+            self._store(value)
+            snapshot()["values"][self._name] = copy.deepcopy(value)
 
             value_in_file = self._get_value_from_file()
             if value == value_in_file:
@@ -88,12 +353,45 @@ class Env:
             else:
                 self._write_value_to_file(value)
 
+    def _apply(self, op, args, update):
+        if not _run_update(self._name, op, *args):
+            return False
+        values = snapshot()["values"]
+        values[self._name] = update(copy.deepcopy(values.get(self._name)) or self._normalize(None))
+        # the file gets whatever Redis holds by the time we have the file lock
+        self._write_value_to_file(self._read)
+        return True
+
+    def compare_and_set(self, expected, value):
+        # only set the value if nobody changed it since we read expected
+        return self._apply("cas", (json.dumps(expected), json.dumps(value)), lambda _: copy.deepcopy(value))
+
+    def add(self, member):
+        # returns whether the member was new
+        return self._apply("sadd", (json.dumps(member),), lambda m: _sorted_members(m + [member]))
+
+    def remove(self, member):
+        # returns whether the member was there
+        return self._apply("srem", (json.dumps(member),), lambda m: [x for x in m if x != member])
+
+    def set_item(self, key: str, value):
+        return self._apply("hset", (key, json.dumps(value)), lambda h: {**h, key: value})
+
+    def remove_item(self, key: str):
+        return self._apply("hdel", (key,), lambda h: {k: v for k, v in h.items() if k != key})
+
+
+# Let's make sure we have an env file
+if not path.isfile(globals.get("env_file_path")):
+    open(globals.get("env_file_path"), "w").close()
+env_file = EnvFile(globals.get("env_file_path"))
 
-env = {
-    "lrelease": Env("lrelease", default="6.0.5217"),
-    "lrelease_date": Env("lrelease_date", default="2024-06-16"),
-    "crelease": Env("crelease", default="6.0.5214"),
-    "crelease_date": Env("crelease_date", default="2024-06-16"),
-    "release_ids": Env("release_ids", default=[]),
-    "pr_summary": Env("pr_summary", default=""),
-}
+with batch():
+    env = {
+        "lrelease": Env("lrelease", default="6.0.5217"),
+        "lrelease_date": Env("lrelease_date", default="2024-06-16"),
+        "crelease": Env("crelease", default="6.0.5214"),
+        "crelease_date": Env("crelease_date", default="2024-06-16"),
+        "release_ids": Env("release_ids", default=[], kind="set"),
+        "pr_summary": Env("pr_summary", default=""),
+    }
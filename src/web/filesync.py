@@ -0,0 +1,75 @@
+import hashlib
+import os
+import shutil
+
+
+# Populate a new copy of a published directory from the build output, reusing the
+# previous copy wherever the content is unchanged: unchanged files are hardlinked
+# (so they keep their mtime and HTTP caches stay valid), only new or changed files
+# are copied, and files that no longer exist in the source are simply not carried
+# over. Content digests are remembered together with size and mtime of the source,
+# so unchanged sources don't even have to be read again.
+class TreeSync:
+    def __init__(self, target_dir: str, previous_dir: str = None, previous_files: dict = None):
+        self._target = target_dir
+        self._previous = previous_dir
+        self._previous_files = previous_files or {}
+        self.files = {}
+        self.report = {"added": [], "changed": [], "unchanged": [], "removed": []}
+
+    def _digest(self, source, rel, st):
+        old = self._previous_files.get(rel)
+        if old and old["size"] == st.st_size and old["mtime_ns"] == st.st_mtime_ns:
+            return old["digest"]
+        h = hashlib.sha256()
+        with open(source, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def add_file(self, source: str, rel: str):
+        st = os.stat(source)
+        digest = self._digest(source, rel, st)
+        self.files[rel] = {"digest": digest, "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+        target = os.path.join(self._target, rel)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        old = self._previous_files.get(rel)
+        if old and old["digest"] == digest and self._previous:
+            try:
+                os.link(os.path.join(self._previous, rel), target)
+                self.report["unchanged"].append(rel)
+                return
+            except OSError:
+                pass
+        shutil.copy2(source, target)
+        self.report["changed" if old else "added"].append(rel)
+
+    def add_tree(self, source_dir: str, rel_dir: str):
+        for root, dirs, files in os.walk(source_dir):
+            dirs.sort()
+            for name in sorted(files):
+                source = os.path.join(root, name)
+                self.add_file(source, os.path.join(rel_dir, os.path.relpath(source, source_dir)))
+
+    def finish(self):
+        self.report["removed"] = sorted(set(self._previous_files) - set(self.files))
+        return self.report
+
+    def summary(self):
+        return ", ".join(f"{len(v)} {k}" for k, v in self.report.items())
+
+
+# atomically point link at target (a sibling directory named like the link plus a
+# suffix); the previous target is kept for requests that are still reading from it,
+# anything older is removed
+def swap_link(link: str, target: str):
+    target = os.path.realpath(target)
+    previous = os.path.realpath(link) if os.path.islink(link) else None
+    tmp_link = f"{link}.{os.getpid()}.tmp"
+    os.symlink(os.path.basename(target), tmp_link)
+    os.replace(tmp_link, link)
+    prefix = f"{os.path.basename(link)}."
+    for entry in os.listdir(os.path.dirname(link)):
+        old = os.path.realpath(os.path.join(os.path.dirname(link), entry))
+        if entry.startswith(prefix) and old not in (target, previous) and os.path.isdir(old):
+            shutil.rmtree(old, ignore_errors=True)
@@ -0,0 +1,146 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+from dotenv import load_dotenv
+
+from .filesync import swap_link
+from .env import generation
+from .globals import globals
+from .jobqueue import DONE, FAILED, RETRY, jobs
+from .locales import languages
+from .metrics import INTERNAL_REQUEST
+from .precompressed import compress_file
+from .redis import redis
+
+# Render every cached content page for every language into a static directory tree
+# the front proxy can serve directly (with .gz / .br variants):
+#     <FREEZE_PATH>/<lang>/<page>/index.html
+# Pages that look different for Windows or Mac visitors get an additional
+# index.windows.html / index.mac.html. A new export is built next to the current
+# one and swapped in atomically. Exporting is a job in the job queue (see
+# schedule_freeze), queued at startup, when a sync changed any page and whenever a
+# new release is published. By hand: python -m src.web.freeze
+USER_AGENTS = {"": "", "windows": "Windows", "mac": "Macintosh"}
+# an export that takes longer than this is abandoned (and the job retried) - it also
+# is how long the lock is held if the worker exporting dies
+FREEZE_TIMEOUT = 10 * 60
+FREEZE_ATTEMPTS = 5
+FREEZE_BACKOFF = 30
+
+_release = redis.register_script(
+    """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+)
+
+
+def freeze_path():
+    return os.environ.get("FREEZE_PATH", f"{globals['app_path']}/frozen")
+
+
+def frozen_pages():
+    from .server import routes
+
+    return [rule for rule, view, options in routes if getattr(view, "cached_page", False) and "<" not in rule]
+
+
+def freeze(app=None):
+    # don't run two exports at the same time - the second one would be identical anyway;
+    # only delete the lock while it is still ours, an export that ran into the timeout
+    # must not release the lock of the next one
+    token = uuid.uuid4().hex
+    if not redis.set("freeze_lock", token, nx=True, ex=FREEZE_TIMEOUT):
+        print("the static export is already being updated")
+        return None
+    try:
+        return _freeze(app or globals["app"], time.monotonic() + FREEZE_TIMEOUT)
+    finally:
+        _release(keys=["freeze_lock"], args=[token])
+
+
+def schedule_freeze(delay: float = 0):
+    jobs.schedule(
+        "freeze", "freeze", {}, delay=delay, max_attempts=FREEZE_ATTEMPTS, backoff=FREEZE_BACKOFF, max_backoff=5 * 60
+    )
+
+
+def freeze_job(attempt):
+    if globals["app"] is None:
+        return FAILED
+    before = generation()
+    if freeze() is None:
+        return RETRY
+    # if the content changed while we were exporting, the export is already out of date
+    return DONE if generation() == before else RETRY
+
+
+def _freeze(app, deadline: float):
+    link = freeze_path()
+    parent = os.path.dirname(link)
+    os.makedirs(parent, exist_ok=True)
+    new_dir = tempfile.mkdtemp(prefix=f"{os.path.basename(link)}.", dir=parent)
+    os.chmod(new_dir, 0o755)
+    client = app.test_client()
+    # these aren't visitors - keep them out of the request metrics
+    client.environ_base[INTERNAL_REQUEST] = True
+    pages = frozen_pages()
+    count = 0
+    english = {}
+    translated = False
+    for lang in languages:
+        # the test client doesn't pass on a Cookie header - it keeps its own cookie jar
+        client.set_cookie("lang", lang)
+        for rule in pages:
+            if time.monotonic() > deadline:
+                print(f"the static export took longer than {FREEZE_TIMEOUT} seconds, giving up")
+                shutil.rmtree(new_dir, ignore_errors=True)
+                return None
+            target_dir = os.path.join(new_dir, lang, rule.strip("/"))
+            os.makedirs(target_dir, exist_ok=True)
+            default = None
+            for variant, user_agent in USER_AGENTS.items():
+                response = client.get(rule, headers={"User-Agent": user_agent})
+                if response.status_code != 200:
+                    print(f"cannot freeze {rule} for {lang}: {response.status_code}")
+                    break
+                html = response.get_data()
+                if default is None:
+                    default = html
+                    if lang == "en":
+                        english[rule] = html
+                    elif html != english.get(rule):
+                        translated = True
+                elif html == default:
+                    continue
+                file_path = os.path.join(target_dir, f"index.{variant}.html" if variant else "index.html")
+                with open(file_path, "wb") as f:
+                    f.write(html)
+                # hundreds of pages - the highest brotli level isn't worth ten times the CPU time
+                compress_file(file_path, brotli_quality=9)
+                count += 1
+    if len(languages) > 1 and not translated:
+        # every language came out in English - don't publish an export that is this broken
+        print("the static export has no translated pages, not using it")
+        shutil.rmtree(new_dir, ignore_errors=True)
+        return None
+    swap_link(link, new_dir)
+    print(f"static export with {count} pages in {link}")
+    return count
+
+
+jobs.register("freeze", freeze_job)
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    from .server import create_app
+
+    if freeze(create_app()) is None:
+        sys.exit(1)
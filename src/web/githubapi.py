@@ -0,0 +1,61 @@
+import json
+import os
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .metrics import metrics
+from .redis import redis
+
+# Minimal client for the few GitHub REST calls the website needs. Responses are kept
+# in Redis together with their ETag and every request is conditional, so polling a
+# release that hasn't changed comes back as a 304 (which GitHub doesn't count
+# against the rate limit) and we simply reuse the cached answer.
+# GITHUB_API_URL allows pointing this at a local stand-in server for testing.
+NIGHTLY_BUILDS_REPO = "subsurface/nightly-builds"
+CACHE_TTL = 7 * 24 * 60 * 60
+TIMEOUT = (5, 30)
+
+
+class GitHubAPI:
+    def __init__(self, base_url: str = None):
+        self._base_url = (base_url or os.environ.get("GITHUB_API_URL", "https://api.github.com")).rstrip("/")
+        self._session = requests.Session()
+        self._session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=4))
+        self._session.mount("http://", HTTPAdapter(pool_connections=2, pool_maxsize=4))
+        self._session.headers.update({"Accept": "application/vnd.github+json", "X-GitHub-Api-Version": "2022-11-28"})
+
+    def _headers(self):
+        # read the token every time - .env may only get loaded after we are created
+        token = os.environ.get("github_token", "").strip()
+        return {"Authorization": f"Bearer {token}"} if token else {}
+
+    def get(self, path: str):
+        # returns the decoded JSON answer, or None if GitHub doesn't know the object;
+        # anything else that goes wrong raises
+        key = f"github_{path}"
+        cached = redis.get(key)
+        cached = json.loads(cached) if cached else None
+        headers = self._headers()
+        if cached:
+            headers["If-None-Match"] = cached["etag"]
+        r = self._session.get(f"{self._base_url}{path}", headers=headers, timeout=TIMEOUT)
+        metrics.inc("website_github_requests_total", kind="api", status=r.status_code)
+        if r.status_code == 304 and cached:
+            print(f"GitHub: {path} unchanged")
+            return cached["data"]
+        if r.status_code == 404:
+            redis.delete(key)
+            return None
+        r.raise_for_status()
+        data = r.json()
+        if r.headers.get("ETag"):
+            redis.set(key, json.dumps({"etag": r.headers["ETag"], "data": data}), ex=CACHE_TTL)
+        return data
+
+    def release(self, release_id: int, repo: str = NIGHTLY_BUILDS_REPO):
+        # the release includes the list of its assets
+        return self.get(f"/repos/{repo}/releases/{release_id}")
+
+
+github = GitHubAPI()
@@ -5,4 +5,6 @@ globals = {
     "testrun": False,
     "app_path": "/web",
     "subsurfacesync": None,
+    "nightlybuilds": None,
+    "app": None,
 }
@@ -0,0 +1,183 @@
+import json
+import sys
+import threading
+import time
+import traceback
+
+from .metrics import metrics
+from .redis import redis
+
+# A small persistent job queue for things that have to happen later (like checking
+# whether all binaries of a release have been uploaded). Jobs are kept in Redis, so
+# they survive restarts of the workers:
+# - {name}_due is a sorted set of job IDs, scored by the time they are due
+# - {name}_state is a hash of job ID -> JSON description and state of the job
+# A consumer claims a due job by pushing its due time out by the visibility timeout;
+# if the consumer dies while running the job, it simply becomes due again after that.
+# Jobs that fail are retried with exponential backoff until they run out of attempts.
+DONE = "done"
+RETRY = "retry"
+FAILED = "failed"
+
+VISIBILITY_TIMEOUT = 5 * 60
+POLL_INTERVAL = 1
+
+_claim = redis.register_script(
+    """
+local ids = redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", ARGV[1], "LIMIT", 0, 1)
+if #ids == 0 then
+    return false
+end
+redis.call("ZADD", KEYS[1], ARGV[2], ids[1])
+return ids[1]
+"""
+)
+# check and enqueue in one go, so two workers scheduling the same job can't both
+# add it - or overwrite it while it runs
+_schedule = redis.register_script(
+    """
+local current = redis.call("HGET", KEYS[1], ARGV[1])
+if current then
+    local state = cjson.decode(current).state
+    if state == "scheduled" or state == "running" then
+        return 0
+    end
+end
+redis.call("HSET", KEYS[1], ARGV[1], ARGV[2])
+redis.call("ZADD", KEYS[2], ARGV[3], ARGV[1])
+return 1
+"""
+)
+
+
+class JobQueue:
+    def __init__(self, name: str = "jobs"):
+        self._due = f"{name}_due"
+        self._state = f"{name}_state"
+        self._handlers = {}
+        self._thread = None
+        self._stop = threading.Event()
+
+    def register(self, kind: str, handler):
+        # handler(attempt=n, **args) returns DONE, RETRY or FAILED (or raises, which means RETRY)
+        self._handlers[kind] = handler
+
+    def schedule(
+        self,
+        job_id: str,
+        kind: str,
+        args: dict,
+        delay: float = 0,
+        max_attempts: int = 5,
+        backoff: float = 60,
+        max_backoff: float = 3600,
+    ):
+        # scheduling a job that is already waiting or running doesn't change it;
+        # a job that finished (or gave up) before is started afresh
+        due = time.time() + delay
+        job = {
+            "kind": kind,
+            "args": args,
+            "state": "scheduled",
+            "attempts": 0,
+            "max_attempts": max_attempts,
+            "backoff": backoff,
+            "max_backoff": max_backoff,
+            "due": due,
+            "error": "",
+            "updated": time.time(),
+        }
+        if not _schedule(keys=[self._state, self._due], args=[job_id, json.dumps(job), due]):
+            return False
+        print(f"scheduled job {job_id} in {delay} seconds")
+        return True
+
+    def job(self, job_id: str):
+        value = redis.hget(self._state, job_id)
+        return json.loads(value) if value else None
+
+    def jobs(self):
+        return {k.decode("utf-8"): json.loads(v) for k, v in redis.hgetall(self._state).items()}
+
+    def forget(self, job_id: str):
+        redis.zrem(self._due, job_id)
+        redis.hdel(self._state, job_id)
+
+    def _save(self, job_id: str, job: dict):
+        job["updated"] = time.time()
+        redis.hset(self._state, job_id, json.dumps(job))
+
+    def run_once(self):
+        # claim and run one due job - returns False if there was nothing to do
+        now = time.time()
+        job_id = _claim(keys=[self._due], args=[now, now + VISIBILITY_TIMEOUT])
+        if job_id is None:
+            return False
+        job_id = job_id.decode("utf-8")
+        job = self.job(job_id)
+        if job is None or job["kind"] not in self._handlers:
+            print(f"don't know how to run job {job_id}, dropping it")
+            redis.zrem(self._due, job_id)
+            return True
+        job["state"] = "running"
+        job["attempts"] += 1
+        self._save(job_id, job)
+        try:
+            result = self._handlers[job["kind"]](attempt=job["attempts"], **job["args"])
+            job["error"] = ""
+        except Exception as e:
+            traceback.print_exc()
+            result = RETRY
+            job["error"] = f"{type(e).__name__}: {e}"
+        if result == RETRY and job["attempts"] >= job["max_attempts"]:
+            print(f"job {job_id} failed {job['attempts']} times, giving up")
+            result = FAILED
+        metrics.inc("website_jobs_total", kind=job["kind"], outcome=result)
+        if result == RETRY:
+            delay = min(job["backoff"] * 2 ** (job["attempts"] - 1), job["max_backoff"])
+            job["state"] = "scheduled"
+            job["due"] = time.time() + delay
+            self._save(job_id, job)
+            redis.zadd(self._due, {job_id: job["due"]})
+            print(f"job {job_id} will be retried in {delay} seconds")
+        else:
+            job["state"] = FAILED if result == FAILED else DONE
+            self._save(job_id, job)
+            redis.zrem(self._due, job_id)
+        return True
+
+    def _run(self, stop: threading.Event):
+        while not stop.is_set():
+            try:
+                while self.run_once() and not stop.is_set():
+                    pass
+            except Exception as e:
+                print(f"job queue consumer failed: {e}")
+            stop.wait(POLL_INTERVAL)
+
+    def start(self):
+        # there only needs to be one consumer - claiming is atomic, though, so more wouldn't hurt.
+        # Every consumer thread gets its own stop event: one that was stopped but is still
+        # busy with its last job just finishes that and goes away, while a new one takes over
+        if self._thread is not None and self._thread.is_alive() and not self._stop.is_set():
+            return
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(self._stop,), name="job-queue", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+jobs = JobQueue()
+
+
+if __name__ == "__main__":
+    # python -m src.web.jobqueue            show all jobs
+    # python -m src.web.jobqueue <job id>   show one job
+    if len(sys.argv) == 2:
+        print(json.dumps(jobs.job(sys.argv[1]), indent=2))
+    else:
+        for job_id, job in sorted(jobs.jobs().items(), key=lambda j: j[1]["due"]):
+            due = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(job["due"]))
+            print(f"{job_id:30} {job['state']:10} attempts {job['attempts']}/{job['max_attempts']}  due {due}  {job['error']}")
@@ -0,0 +1,97 @@
+import os
+import socket
+import threading
+import uuid
+
+from .redis import redis
+
+# One of the workers (on any host sharing the Redis instance) is the leader and does
+# all the background work. Leadership is a key in Redis that only lives for ttl
+# seconds unless the leader keeps renewing it; if the leader dies or hangs, the key
+# expires and the next worker that tries takes over. Renewing and releasing only
+# touch the key while it still holds our token, so a worker that lost the lease can
+# never extend or delete somebody else's.
+_renew = redis.register_script(
+    """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("EXPIRE", KEYS[1], ARGV[2])
+end
+return 0
+"""
+)
+_release = redis.register_script(
+    """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+)
+
+
+class LeaderLease:
+    def __init__(self, key: str = "leader", ttl: int = 30):
+        self._key = key
+        self._ttl = ttl
+        self.token = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.is_leader = False
+
+    def holder(self):
+        value = redis.get(self._key)
+        return value.decode("utf-8") if value else None
+
+    def try_acquire(self):
+        # extend the lease if it is ours, take it if nobody has it - returns whether we are the leader
+        self.is_leader = bool(_renew(keys=[self._key], args=[self.token, self._ttl])) or bool(
+            redis.set(self._key, self.token, nx=True, ex=self._ttl)
+        )
+        return self.is_leader
+
+    def release(self):
+        if self.is_leader:
+            _release(keys=[self._key], args=[self.token])
+        self.is_leader = False
+
+
+# Keep trying to get (or renew) the lease every interval seconds; call on_acquire
+# when we become the leader and on_loss when we lose the lease again.
+class LeaseKeeper:
+    def __init__(self, lease: LeaderLease, on_acquire, on_loss, interval: float = 10):
+        self.lease = lease
+        self._on_acquire = on_acquire
+        self._on_loss = on_loss
+        self._interval = interval
+        self._thread = None
+        self._stop = threading.Event()
+
+    def _check(self):
+        was_leader = self.lease.is_leader
+        try:
+            leader = self.lease.try_acquire()
+        except Exception as e:
+            # without Redis we can't know whether somebody else took over - assume so
+            print(f"cannot renew the leader lease: {e}")
+            self.lease.is_leader = leader = False
+        if leader and not was_leader:
+            print(f"process {os.getpid()} is now the leader ({self.lease.token})")
+            self._on_acquire()
+        elif was_leader and not leader:
+            print(f"process {os.getpid()} lost the leader lease")
+            self._on_loss()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._check()
+            self._stop.wait(self._interval)
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="leader-lease", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self.lease.is_leader:
+            self._on_loss()
+        self.lease.release()
@@ -0,0 +1,61 @@
+from functools import lru_cache
+
+from werkzeug.datastructures import LanguageAccept
+from werkzeug.http import parse_accept_header
+
+languages = [
+    "en",
+    "ca",
+    "de_DE",
+    "de",
+    "el_GR",
+    "el",
+    "es_ES",
+    "es",
+    "fi_FI",
+    "fi",
+    "fr_FR",
+    "fr",
+    "hr_HR",
+    "hr",
+    "hu_HU",
+    "hu",
+    "it_IT",
+    "it",
+    "ko_KR",
+    "ko",
+    "nl_NL",
+    "nl",
+    "pt_BR",
+    "pt_PT",
+    "pt",
+    "sv_SE",
+    "sv",
+]
+
+# every spelling we accept (de, DE, de-de, de_DE, ...) normalizes to lower case with an
+# underscore; map all of those, and every bare language code, to the language we serve
+_aliases = {}
+for _lang in languages:
+    _aliases.setdefault(_lang.lower(), _lang)
+for _lang in languages:
+    _aliases.setdefault(_lang.split("_")[0].lower(), _lang)
+
+
+@lru_cache(maxsize=1024)
+def resolve_language(lang_code):
+    if not lang_code:
+        return None
+    normalized = lang_code.replace("-", "_").lower()
+    language = _aliases.get(normalized)
+    if language is None:
+        language = _aliases.get(normalized.split("_", 1)[0])
+    return language
+
+
+# browsers send a handful of distinct Accept-Language headers over and over
+@lru_cache(maxsize=1024)
+def resolve_accept_language(header):
+    if not header:
+        return None
+    return resolve_language(parse_accept_header(header, LanguageAccept).best_match(languages))
@@ -0,0 +1,132 @@
+import os
+import sys
+import threading
+import time
+
+from dotenv import load_dotenv
+
+from .assetdownloader import schedule_release_check, updateReleaseWebsite
+from .env import env, generation
+from .freeze import freeze, schedule_freeze
+from .globals import globals
+from .jobqueue import jobs
+from .leader import LeaderLease, LeaseKeeper
+from .subsurfacesync import NightlyBuilds, SubsurfaceSync
+from .webhooks import webhook_events
+
+# Everything that used to happen as a side effect of importing the server lives here,
+# so gunicorn can preload the app in the master and fork the workers from it:
+# - init_worker() is called in every worker after the fork (see gunicorn.conf.py); all
+#   workers compete for the leader lease, and whichever holds it does the background
+#   work: the initial sync, a periodic sync every SYNC_INTERVAL seconds (default 15
+#   minutes) and consuming the job queue and the webhook events
+# - running this module does the same work by hand:
+#     python -m src.web.maintenance sync       clone / pull Subsurface, rebuild the docs, index the nightly builds,
+#                                              update the static export
+#     python -m src.web.maintenance releases   update the website for all remembered release IDs right now
+
+
+def initial_sync():
+    print("make sure Subsurface tree is checked out and current")
+    globals["subsurfacesync"].setup()
+    globals["subsurfacesync"].sync()
+    print("indexing the nightly builds")
+    globals["nightlybuilds"].sync()
+    if globals["app"] is not None:
+        print("updating the static export")
+        schedule_freeze()
+
+
+def periodic_sync():
+    # pull, rebuild what changed and - if that changed any page - update the static export
+    before = generation()
+    globals["subsurfacesync"].sync()
+    globals["nightlybuilds"].sync()
+    if globals["app"] is not None and generation() != before:
+        print("content changed, updating the static export")
+        schedule_freeze()
+
+
+class Supervisor:
+    def __init__(self, sync_interval: float = None):
+        self._sync_interval = sync_interval or float(os.environ.get("SYNC_INTERVAL", 15 * 60))
+        self._keeper = LeaseKeeper(LeaderLease(), self._became_leader, self._lost_leadership)
+        self._thread = None
+        self._leading = threading.Event()
+
+    def _became_leader(self):
+        print("processing any remembered release IDs")
+        for release_id in env["release_ids"].value:
+            # jobs survive restarts, this only picks up release IDs whose job gave up
+            # (or that were remembered before there was a job queue)
+            schedule_release_check(release_id, 10)
+        jobs.start()
+        webhook_events.start()
+        self._leading.set()
+        # cloning, pulling and building the documentation can take a while - do that
+        # in the background, the site works fine with the previous copy in the meantime
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._sync_loop, name="periodic-sync", daemon=True)
+            self._thread.start()
+
+    def _lost_leadership(self):
+        self._leading.clear()
+        jobs.stop()
+        webhook_events.stop()
+
+    def _sync_loop(self):
+        task = initial_sync
+        while True:
+            self._leading.wait()
+            started = time.monotonic()
+            try:
+                task()
+            except Exception as e:
+                print(f"background sync failed: {e}")
+            task = periodic_sync
+            time.sleep(max(0, self._sync_interval - (time.monotonic() - started)))
+
+    def start(self):
+        self._keeper.start()
+
+    def stop(self):
+        self._keeper.stop()
+
+
+supervisor = None
+
+
+def init_worker():
+    global supervisor
+    supervisor = Supervisor()
+    supervisor.start()
+
+
+def exit_worker():
+    # hand the lease over right away instead of making the others wait for it to expire
+    if supervisor is not None:
+        supervisor.stop()
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    if globals["subsurfacesync"] is None:
+        globals["subsurfacesync"] = SubsurfaceSync()
+    if globals["nightlybuilds"] is None:
+        globals["nightlybuilds"] = NightlyBuilds()
+    command = sys.argv[1] if len(sys.argv) == 2 else ""
+    if command in ("sync", "releases"):
+        from .server import create_app
+
+        create_app()
+    if command == "sync":
+        initial_sync()
+        # nothing consumes the job queue here - export right away
+        freeze()
+    elif command == "releases":
+        for release_id in env["release_ids"].value:
+            print(f"updating website for release with release_id {release_id}")
+            updateReleaseWebsite(release_id=release_id)
+    else:
+        print("call with 'sync' or 'releases' as argument")
+        sys.exit(1)
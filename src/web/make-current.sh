@@ -4,6 +4,7 @@
 #
 # this doesn't include (of course) the signing of the Windows and macOS installers
 # also - you'll need to restart the docker container for the website afterwards
+# (which also regenerates the static export of the pages)
 
 croak() {
     echo "$*" ; exit 1
@@ -0,0 +1,67 @@
+import json
+import os
+
+from flask import abort, send_from_directory
+
+from .env import generation
+from .precompressed import send_precompressed
+
+# how long browsers may keep manual images without asking again - they are
+# revalidated by content hash after that
+IMAGE_MAX_AGE = 7 * 24 * 60 * 60
+
+
+# The manifest written when the manuals are published knows every manual, the
+# languages it exists in and the content hash of every file. Publishing bumps the
+# Env generation, so each worker only rereads it after a new publication.
+# Until the first publication (fresh deploy or upgrade) the manuals that older
+# versions built straight into static/ are served instead.
+class ManualManifest:
+    def __init__(self, static_dir: str):
+        self._static_dir = static_dir
+        self._link = os.path.join(static_dir, "manuals")
+        self._generation = None
+        self._directory = None
+        self._manifest = {}
+
+    def _current(self):
+        gen = generation()
+        if gen != self._generation:
+            directory = os.path.realpath(self._link)
+            try:
+                with open(os.path.join(directory, "manifest.json"), "r") as f:
+                    self._manifest = json.load(f)
+                self._directory = directory
+            except (FileNotFoundError, json.JSONDecodeError):
+                self._manifest = {}
+                self._directory = None
+            self._generation = gen
+        return self._directory, self._manifest
+
+    def send_manual(self, manual: str, language: str):
+        directory, manifest = self._current()
+        if not directory:
+            return self._send_unpublished_manual(manual, language)
+        variants = manifest.get("manuals", {}).get(manual)
+        if not variants:
+            abort(404)
+        file_name = variants.get((language or "")[:2]) or variants.get("en")
+        info = manifest["files"][file_name]
+        return send_precompressed(directory, file_name, etag=info["digest"], encodings=info.get("encodings", []))
+
+    def send_file(self, rel_path: str):
+        directory, manifest = self._current()
+        if not directory:
+            return send_from_directory(self._static_dir, rel_path, max_age=IMAGE_MAX_AGE)
+        info = manifest.get("files", {}).get(os.path.normpath(rel_path))
+        if not info:
+            abort(404)
+        return send_precompressed(
+            directory, os.path.normpath(rel_path), etag=info["digest"], encodings=(), max_age=IMAGE_MAX_AGE
+        )
+
+    def _send_unpublished_manual(self, manual: str, language: str):
+        language = (language or "")[:2]
+        if language.isalpha() and os.path.isfile(os.path.join(self._static_dir, f"{manual}_{language}.html")):
+            return send_from_directory(self._static_dir, f"{manual}_{language}.html")
+        return send_from_directory(self._static_dir, f"{manual}.html")
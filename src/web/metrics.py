@@ -0,0 +1,232 @@
+import atexit
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import g, request
+
+from .redis import redis
+
+# Counters and histograms for /metrics in the Prometheus text format. Every worker
+# (and every background thread) counts in memory and adds its numbers to one Redis
+# hash every few seconds, so what /metrics reports is the sum over all workers.
+# Histogram buckets are stored cumulative, the way Prometheus wants them.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SUBPROCESS_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600)
+CALL_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+METRICS = {
+    "website_requests_total": ("counter", "HTTP requests by endpoint, method and status"),
+    "website_request_duration_seconds": ("histogram", "HTTP request latency by endpoint", LATENCY_BUCKETS),
+    "website_template_render_seconds": ("histogram", "template render time by template", LATENCY_BUCKETS),
+    "website_redis_command_seconds": ("histogram", "Redis command latency (and count) by command", LATENCY_BUCKETS),
+    "website_request_redis_calls": ("histogram", "Redis commands per HTTP request by endpoint", CALL_BUCKETS),
+    "website_request_redis_seconds": ("histogram", "time spent in Redis per HTTP request by endpoint", LATENCY_BUCKETS),
+    "website_subprocess_seconds": ("histogram", "duration of git, make and other external commands", SUBPROCESS_BUCKETS),
+    "website_github_requests_total": ("counter", "requests to GitHub by kind and status"),
+    "website_jobs_total": ("counter", "background jobs run by kind and outcome"),
+    "website_webhook_events_total": ("counter", "webhook events processed by outcome"),
+}
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+
+def _labels(labels: dict):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in sorted(labels.items())) + "}"
+
+
+# one labelled histogram; counts[i] is the number of observations in bucket i only
+# (the last one is +Inf), they are only summed up to cumulative buckets when flushing
+class _Histogram:
+    __slots__ = ("name", "labels", "buckets", "counts", "sum")
+
+    def __init__(self, name: str, labels: dict):
+        self.name = name
+        self.labels = labels
+        self.buckets = METRICS[name][2]
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+
+class Metrics:
+    def __init__(self, key: str = "metrics", interval: float = 10):
+        self._key = key
+        self._interval = interval
+        self._values = Counter()
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+    def inc(self, name: str, n: float = 1, **labels):
+        with self._lock:
+            self._values[f"{name}{_labels(labels)}"] += n
+        self._maybe_flush()
+
+    def histogram(self, name: str, **labels):
+        # callers on a hot path can keep the histogram and use observe_histogram()
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, _Histogram(name, labels))
+        return histogram
+
+    def observe(self, name: str, value: float, **labels):
+        self.observe_histogram(self.histogram(name, **labels), value)
+
+    def observe_histogram(self, histogram: _Histogram, value: float):
+        i = bisect_left(histogram.buckets, value)
+        with self._lock:
+            histogram.counts[i] += 1
+            histogram.sum += value
+        self._maybe_flush()
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def _maybe_flush(self):
+        if time.monotonic() - self._last_flush >= self._interval:
+            self.flush()
+
+    def flush(self):
+        observed = []
+        with self._lock:
+            values, self._values = self._values, Counter()
+            for histogram in self._histograms.values():
+                if any(histogram.counts):
+                    observed.append((histogram, histogram.counts, histogram.sum))
+                    histogram.counts = [0] * len(histogram.counts)
+                    histogram.sum = 0.0
+            self._last_flush = time.monotonic()
+        for histogram, counts, total in observed:
+            name, labels = histogram.name, histogram.labels
+            cumulative = 0
+            for le, n in zip(histogram.buckets + ("+Inf",), counts):
+                cumulative += n
+                if cumulative:
+                    values[f"{name}_bucket{_labels({**labels, 'le': le})}"] += cumulative
+            values[f"{name}_sum{_labels(labels)}"] += total
+            values[f"{name}_count{_labels(labels)}"] += cumulative
+        if not values:
+            return
+        try:
+            pipe = redis.pipeline(transaction=False)
+            for field, n in values.items():
+                pipe.hincrbyfloat(self._key, field, n)
+            pipe.execute()
+        except Exception as e:
+            print(f"failed to flush metrics: {e}")
+
+    def render(self):
+        self.flush()
+        by_metric = {}
+        for field, value in redis.hgetall(self._key).items():
+            field = field.decode("utf-8")
+            series = field.split("{", 1)[0]
+            name = next((m for m in METRICS if series in (m, f"{m}_bucket", f"{m}_sum", f"{m}_count")), series)
+            value = float(value)
+            by_metric.setdefault(name, []).append(f"{field} {int(value) if value.is_integer() else value}")
+        lines = []
+        for name in sorted(by_metric):
+            if name in METRICS:
+                lines.append(f"# HELP {name} {METRICS[name][1]}")
+                lines.append(f"# TYPE {name} {METRICS[name][0]}")
+            lines += sorted(by_metric[name])
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+atexit.register(metrics.flush)
+
+
+# Redis commands are timed on the client itself, so every module's calls are counted;
+# pipelines only show up as the commands that aren't part of them
+_request = threading.local()
+
+
+def instrument_redis(client):
+    execute_command = client.execute_command
+    # this runs for every single Redis command - look up the histogram once per command name
+    histograms = {}
+
+    def timed_execute_command(*args, **options):
+        start = time.perf_counter()
+        try:
+            return execute_command(*args, **options)
+        finally:
+            elapsed = time.perf_counter() - start
+            command = args[0] if args else "?"
+            histogram = histograms.get(command)
+            if histogram is None:
+                histogram = histograms[command] = metrics.histogram("website_redis_command_seconds", command=str(command).upper())
+            metrics.observe_histogram(histogram, elapsed)
+            if getattr(_request, "active", False):
+                _request.calls += 1
+                _request.seconds += elapsed
+
+    client.execute_command = timed_execute_command
+
+
+instrument_redis(redis)
+
+
+# request and template hooks, registered by create_app(); requests the website sends
+# itself (like the static export) set INTERNAL_REQUEST in the environ and aren't counted
+INTERNAL_REQUEST = "website.internal_request"
+# the method is whatever the client sends - anything unusual is counted as "other"
+HTTP_METHODS = frozenset(("GET", "HEAD", "POST", "PUT", "DELETE", "OPTIONS", "PATCH"))
+
+
+def count_request(endpoint: str, method: str, status: int, seconds: float):
+    # also used by the redirect middleware, whose requests never reach Flask
+    method = method if method in HTTP_METHODS else "other"
+    metrics.inc("website_requests_total", endpoint=endpoint, method=method, status=status)
+    metrics.observe("website_request_duration_seconds", seconds, endpoint=endpoint)
+
+
+def start_request_timer():
+    if request.environ.get(INTERNAL_REQUEST):
+        return
+    g.metrics_start = time.perf_counter()
+    _request.active = True
+    _request.calls = 0
+    _request.seconds = 0.0
+
+
+def record_response(response):
+    g.metrics_status = response.status_code
+    return response
+
+
+def record_request(exc=None):
+    # a teardown hook, so it also runs when the view raised - and then there's no response
+    start = g.pop("metrics_start", None)
+    if start is not None:
+        endpoint = request.endpoint or "none"
+        count_request(endpoint, request.method, g.pop("metrics_status", 500), time.perf_counter() - start)
+        metrics.observe("website_request_redis_calls", _request.calls, endpoint=endpoint)
+        metrics.observe("website_request_redis_seconds", _request.seconds, endpoint=endpoint)
+    _request.active = False
+
+
+def template_started(sender, template, context, **extra):
+    if "metrics_start" not in g:
+        return
+    g.setdefault("metrics_templates", {})[template.name] = time.perf_counter()
+
+
+def template_finished(sender, template, context, **extra):
+    start = g.get("metrics_templates", {}).pop(template.name, None)
+    if start is not None:
+        metrics.observe("website_template_render_seconds", time.perf_counter() - start, template=template.name)
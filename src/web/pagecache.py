@@ -0,0 +1,39 @@
+from functools import wraps
+
+from flask import request
+from flask_babel import get_locale
+
+from .env import generation
+from .redis import redis
+
+# rendered pages only depend on the template, the locale, the Env values (tracked
+# through the Env generation) and - for the home page - on whether the visitor is
+# on Windows or a Mac. Cache the rendered HTML in Redis so all workers share it;
+# entries for older generations simply expire
+PAGE_CACHE_TTL = 24 * 60 * 60
+
+
+def user_agent_variant():
+    ua = request.user_agent.string
+    return f"{'w' if 'Windows' in ua else ''}{'m' if 'Mac' in ua else ''}" or "o"
+
+
+def page_cache_key():
+    return f"page_{request.endpoint}_{get_locale()}_{user_agent_variant()}_{generation()}"
+
+
+def cached_page(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = page_cache_key()
+        html = redis.get(name=key)
+        if html is not None:
+            return html.decode("utf-8")
+        html = view(*args, **kwargs)
+        if isinstance(html, str):
+            redis.set(name=key, value=html, ex=PAGE_CACHE_TTL)
+        return html
+
+    # these pages are also part of the static export (see freeze.py)
+    wrapper.cached_page = True
+    return wrapper
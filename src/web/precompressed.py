@@ -0,0 +1,92 @@
+import gzip
+import mimetypes
+import os
+import shutil
+
+from flask import current_app, request, send_from_directory
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# The manuals are large single HTML documents and the stylesheet is the same for
+# every page - compress them once when they are published (as .gz and .br siblings)
+# and pick the best variant the client accepts when serving them
+COMPRESSIBLE = (".html", ".css", ".js", ".svg", ".json", ".txt")
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+
+def _up_to_date(variant, source):
+    # variants get the mtime of their source when they are created
+    return os.path.isfile(variant) and os.stat(variant).st_mtime_ns == os.stat(source).st_mtime_ns
+
+
+def compress_file(file_path: str, previous: str = None, brotli_quality: int = 11):
+    # if the same content was published before, just link the variants we already have
+    if previous:
+        try:
+            for _, ext in ENCODINGS:
+                if os.path.isfile(previous + ext) and not os.path.exists(file_path + ext):
+                    os.link(previous + ext, file_path + ext)
+        except OSError:
+            pass
+    with open(file_path, "rb") as f:
+        data = None
+        if not _up_to_date(file_path + ".gz", file_path):
+            data = f.read()
+            with open(f"{file_path}.gz.tmp", "wb") as out:
+                out.write(gzip.compress(data, compresslevel=9, mtime=0))
+            os.replace(f"{file_path}.gz.tmp", f"{file_path}.gz")
+        if brotli and not _up_to_date(file_path + ".br", file_path):
+            data = data if data is not None else f.read()
+            with open(f"{file_path}.br.tmp", "wb") as out:
+                out.write(brotli.compress(data, quality=brotli_quality))
+            os.replace(f"{file_path}.br.tmp", f"{file_path}.br")
+    for _, ext in ENCODINGS:
+        if os.path.isfile(file_path + ext):
+            shutil.copystat(file_path, file_path + ext)
+
+
+def compress_tree(directory: str, skip=()):
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = [d for d in dirs if not any(d.startswith(s) for s in skip)]
+        for name in files:
+            if name.endswith(COMPRESSIBLE):
+                compress_file(os.path.join(root, name))
+
+
+def send_precompressed(directory: str, filename: str, etag: str = None, encodings=None, **kwargs):
+    # encodings lists the variants known to exist; without it we look for them on disk
+    # etag is the content hash of the file, if the caller has it; it lets us answer a
+    # revalidation without touching the file system at all; everything else goes through
+    # send_from_directory, which sets Last-Modified and answers If-Modified-Since
+    chosen = None
+    for encoding, ext in ENCODINGS:
+        if not request.accept_encodings[encoding]:
+            continue
+        if encodings is not None and encoding not in encodings:
+            continue
+        if encodings is None and not os.path.isfile(os.path.join(directory, filename + ext)):
+            continue
+        chosen = encoding, ext
+        break
+    if etag and chosen:
+        etag = f"{etag}-{chosen[0]}"
+    # revalidations may send the weak form of the ETag (e.g. after a proxy compressed the response)
+    if etag and request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status=304)
+        response.set_etag(etag)
+        if kwargs.get("max_age"):
+            response.cache_control.public = True
+            response.cache_control.max_age = kwargs["max_age"]
+        else:
+            response.cache_control.no_cache = True
+    elif chosen:
+        kwargs.setdefault("mimetype", mimetypes.guess_type(filename)[0])
+        response = send_from_directory(directory, filename + chosen[1], etag=etag or True, **kwargs)
+        response.headers["Content-Encoding"] = chosen[0]
+    else:
+        response = send_from_directory(directory, filename, etag=etag or True, **kwargs)
+    response.vary.add("Accept-Encoding")
+    return response
@@ -0,0 +1,58 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .metrics import metrics
+from .redis import redis
+
+# Every nightly build release has the title of the PR it was built from attached.
+# Those never change, so once we know the title for a build number (or know that
+# there is none) it is kept in the pr_titles hash for good and never fetched again.
+# Titles we don't know yet are fetched in parallel, with strict timeouts, so a
+# hanging download can't stall the release update.
+PR_TITLES = "pr_titles"
+PR_TITLE_URL = "https://github.com/subsurface/nightly-builds/releases/download/v6.0.{bn}-CICD-release/release_content_title.txt"
+TIMEOUT = (5, 10)
+MAX_WORKERS = 5
+
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=MAX_WORKERS))
+
+
+def _fetch(bn: int):
+    # returns the title, "" if the build has none, or None if we couldn't tell
+    try:
+        r = _session.get(PR_TITLE_URL.format(bn=bn), timeout=TIMEOUT)
+    except requests.RequestException as e:
+        metrics.inc("website_github_requests_total", kind="download", status="error")
+        print(f"failed to get PR title for build number {bn}: {e}")
+        return None
+    metrics.inc("website_github_requests_total", kind="download", status=r.status_code)
+    if r.status_code == 200:
+        print(f"finished build number {bn}, got PR title {r.content.decode()}")
+        return r.content.decode()
+    if r.status_code == 404:
+        print(f"no PR title for build number {bn}")
+        return ""
+    print(f"failed to get PR title for build number {bn}: HTTP {r.status_code}")
+    return None
+
+
+def get_pr_titles(build_numbers: list):
+    # returns a dict build number -> title ("" if there is none)
+    build_numbers = list(build_numbers)
+    known = redis.hmget(PR_TITLES, build_numbers) if build_numbers else []
+    titles = {bn: t.decode("utf-8") for bn, t in zip(build_numbers, known) if t is not None}
+    missing = [bn for bn in build_numbers if bn not in titles]
+    if missing:
+        with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(missing))) as executor:
+            fetched = dict(zip(missing, executor.map(_fetch, missing)))
+        # the title of the newest build may just not be uploaded yet - only remember
+        # that there is none for older builds
+        newest = max(build_numbers)
+        remember = {bn: t for bn, t in fetched.items() if t or (t == "" and bn != newest)}
+        if remember:
+            redis.hset(PR_TITLES, mapping=remember)
+        titles.update({bn: t or "" for bn, t in fetched.items()})
+    return titles
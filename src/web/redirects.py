@@ -0,0 +1,67 @@
+import time
+from urllib.parse import urlencode
+
+from werkzeug.utils import redirect
+from werkzeug.wrappers import Request
+
+from .locales import languages, resolve_language
+from .metrics import count_request
+
+# how long browsers, proxies and CDNs may remember the redirects for the old
+# /misc/ and /documentation/ URLs
+REDIRECT_MAX_AGE = 24 * 60 * 60
+
+
+# WSGI middleware that answers the URLs of the old website before Flask even starts
+# routing: /<lang>/<path> is sent on to /<path> (remembering the language in a cookie),
+# /misc/<path> and /documentation/<path> permanently lose their first path component.
+# A single dict lookup on the first path component decides whether a request is ours.
+class LegacyRedirects:
+    def __init__(self, app):
+        self._app = app
+        # first path component -> language to remember, or None to just strip it
+        self._prefixes = {"misc": None, "documentation": None}
+        for lang in languages:
+            self._prefixes[lang] = resolve_language(lang)
+            if len(lang) > 2 and lang[2] == "_":
+                self._prefixes[lang[:2]] = resolve_language(lang[:2])
+
+    def __call__(self, environ, start_response):
+        path = environ.get("PATH_INFO", "")
+        first, slash, rest = path[1:].partition("/")
+        if first not in self._prefixes:
+            return self._app(environ, start_response)
+        lang = self._prefixes[first]
+        if lang is None and not rest:
+            # /documentation/ is a page of its own
+            return self._app(environ, start_response)
+        start = time.perf_counter()
+        request = Request(environ)
+        response = self._redirect(request, first, lang)
+        count_request("legacy_redirect", request.method, response.status_code, time.perf_counter() - start)
+        return response(environ, start_response)
+
+    def _redirect(self, request, first, lang):
+        # POSTs have to stay POSTs
+        get = request.method in ("GET", "HEAD")
+        # /de//example.com must not turn into //example.com - browsers take that (and
+        # /\example.com) as a link to another site
+        target = "/" + request.path[len(first) + 2 :].lstrip("/\\")
+        if lang is None:
+            # permanent and the same for everyone
+            query = request.full_path[len(request.path) :].rstrip("?")
+            response = redirect(target + query, 301 if get else 308)
+            response.cache_control.public = True
+            response.cache_control.max_age = REDIRECT_MAX_AGE
+            return response
+
+        query_args = request.args.to_dict(flat=False)
+        query_args.pop("lang", None)
+        if query_args:
+            target = f"{target}?{urlencode(query_args, doseq=True)}"
+        # a cached redirect would never reach us again - and so never set the cookie again
+        # after the visitor picked a different language - so this one is temporary and uncached
+        response = redirect(target, 302 if get else 307)
+        response.set_cookie("lang", lang, max_age=31536000, samesite="Lax", secure=request.is_secure)  # 1 year
+        response.cache_control.no_store = True
+        return response
@@ -3,91 +3,70 @@ import hmac
 import json
 import os
 import re
+from functools import lru_cache
 from pathlib import Path
-from urllib.parse import urlencode
+from urllib.parse import quote, urlencode
 from semver.version import Version
 
 from .globals import globals
+from .locales import languages, resolve_accept_language, resolve_language
 from .subsurfacesync import NightlyBuilds, SubsurfaceSync
 
-# if we are running standalone for testing, we don't need or want redis
-if __name__ != "__main__":
-    from .redis import redis
-else:
+# if we are running standalone for testing, the Subsurface tree lives next to our sources
+if __name__ == "__main__":
     globals["testrun"] = True
     path = Path(__file__)
     globals["app_path"] = path.parent.parent.parent.absolute()
 
 
-from .assetdownloader import AssetDownloader
-from .env import Env, env
+from .divecomputers import dive_computers
+from .env import Env, env, pin_snapshot, unpin_snapshot
+from .manuals import ManualManifest
+from .metrics import (
+    metrics,
+    record_request,
+    record_response,
+    start_request_timer,
+    template_finished,
+    template_started,
+)
+from .pagecache import cached_page
+from .precompressed import send_precompressed
+from .redirects import LegacyRedirects
+from .telemetry import updatecheck_stats
+from .webhooks import webhook_events
 
 from dotenv import load_dotenv
-from flask_babel import Babel, get_translations, get_locale as gl
+from flask_babel import Babel, force_locale, get_translations
 from flask import (
     Flask,
+    before_render_template,
+    current_app,
+    g,
     redirect,
     render_template,
     request,
     send_from_directory,
     make_response,
+    template_rendered,
 )
-from werkzeug.exceptions import Forbidden
+from werkzeug.exceptions import Forbidden, NotFound
 
 description = """
 Simple backend to run the Subsurface website
 """
-languages = [
-    "en",
-    "ca",
-    "de_DE",
-    "de",
-    "el_GR",
-    "el",
-    "es_ES",
-    "es",
-    "fi_FI",
-    "fi",
-    "fr_FR",
-    "fr",
-    "hr_HR",
-    "hr",
-    "hu_HU",
-    "hu",
-    "it_IT",
-    "it",
-    "ko_KR",
-    "ko",
-    "nl_NL",
-    "nl",
-    "pt_BR",
-    "pt_PT",
-    "pt",
-    "sv_SE",
-    "sv",
-]
 load_dotenv()
 
 
-def resolve_language(lang_code):
-    if not lang_code:
-        return None
-    normalized = lang_code.replace("-", "_")
-    parts = normalized.split("_", 1)
-    base = parts[0].lower()
-    region = parts[1].upper() if len(parts) == 2 else ""
-    normalized = f"{base}_{region}" if region else base
-    if normalized in languages:
-        return normalized
-    if base in languages:
-        return base
-    for candidate in languages:
-        if candidate.startswith(f"{base}_"):
-            return candidate
-    return None
+def get_locale():
+    # Flask-Babel, the language redirect, the manuals and the templates all ask - only work it out once
+    locale = g.get("locale")
+    if locale is None:
+        locale = g.locale = _negotiate_locale()
+    return locale
 
 
-def get_locale():
+def _negotiate_locale():
     lang_from_query = resolve_language(request.args.get("lang"))
     if lang_from_query:
         return lang_from_query
@@ -96,44 +75,36 @@ def get_locale():
     if lang_from_cookie:
         return lang_from_cookie
 
-    lang_from_header = resolve_language(request.accept_languages.best_match(languages))
+    lang_from_header = resolve_accept_language(request.headers.get("Accept-Language"))
     if lang_from_header:
         return lang_from_header
 
     return "en"
 
 
-app = Flask(__name__)
-babel = Babel(app, locale_selector=get_locale)
 globals["subsurfacesync"] = SubsurfaceSync()
 globals["nightlybuilds"] = NightlyBuilds()
-if __name__ != "__main__":
-    # if this runs under gunicorn as a production server,
-    # we want only one of the workers to process any outstanding release IDs
-    # try to create the lock in Redis and hold it for 30 seconds
-    # (by which time all the other workers have gotten past this code)
-    redis.set(name="initWorker", value=os.getpid(), nx=True, ex=30)
-    lock = int(redis.get(name="initWorker"))
-    print(f"process {os.getpid()} got lock {lock}")
-    if lock == os.getpid():
-        print("this is the initWorker")
-        print("make sure Subsurface tree is checked out and current")
-        globals["subsurfacesync"].setup()
-        globals["subsurfacesync"].sync()
-        print("processing any remembered release IDs")
-        for release_id in env["release_ids"].value:
-            # we got restarted while waiting for releases to populate - remove their locks
-            redis.delete(f"processing_{release_id}")
-            # we don't know how long we've been waiting, so give it a few seconds and then check
-            AssetDownloader(release_id, 10)
-    else:
-        print(f"worker {lock} is dealing with release IDs")
-else:
-    globals["subsurfacesync"].setup()
-    globals["subsurfacesync"].sync()
+
+# the routes are collected here and registered on the app by create_app()
+routes = []
+
+
+def route(rule, **options):
+    def decorator(view):
+        routes.append((rule, view, options))
+        return view
+
+    return decorator
+
+
+def pin_env_snapshot():
+    pin_snapshot()
+
+
+def unpin_env_snapshot(exc):
+    unpin_snapshot()
 
 
-@app.before_request
 def persist_language_and_clean_url():
     if request.method != "GET":
         return None
@@ -151,7 +122,6 @@ def persist_language_and_clean_url():
         return resp
 
 
-@app.context_processor
 def utility_processor():
     def get_env(key):
         if key in env.keys():
@@ -183,55 +153,30 @@ def utility_processor():
     return dict(get_env=get_env)
 
 
-# helper function to consistently redirect multi-level paths to the new flat url scheme
-def redirector(urlpath=""):
-    print(f"universal redirector for request {request.full_path} with urlpath {urlpath}")
-    first = request.path.split("/")[1]
-    lang_from_path = resolve_language(first)
-
-    if first == "misc" or first == "documentation":
-        print(f"converting to {request.full_path.replace(f'/{first}', '')}")
-        target = request.full_path.replace(f"/{first}", "")
-        if target.endswith("?"):
-            target = target[:-1]
-        return redirect(target or "/")
-
-    target_path = f"/{urlpath}" if urlpath else "/"
-    query_args = request.args.to_dict(flat=False)
-    query_args.pop("lang", None)
-    if query_args:
-        target_path = f"{target_path}?{urlencode(query_args, doseq=True)}"
-    resp = make_response(redirect(target_path))
-    if lang_from_path:
-        resp.set_cookie("lang", lang_from_path, max_age=31536000, samesite="Lax", secure=request.is_secure)  # 1 year
-    return resp
-
-
-# next set up the various language routes as well as the misc and documentation routes
-for l in languages:
-    app.add_url_rule(f"/{l}/", view_func=redirector)
-    app.add_url_rule(f"/{l}/<path:urlpath>", view_func=redirector)
-    if len(l) > 2 and l[2] == "_":
-        app.add_url_rule(f"/{l[:2]}/", view_func=redirector)
-        app.add_url_rule(f"/{l[:2]}/<path:urlpath>", view_func=redirector)
-app.add_url_rule(f"/misc/<path:urlpath>", view_func=redirector)
-app.add_url_rule(f"/documentation/<path:urlpath>", view_func=redirector)
-
-
-@app.route("/favicon.ico")
+# serve the precompressed variants of our static assets where we have them
+def static_precompressed(filename):
+    return send_precompressed(
+        current_app.static_folder, filename, max_age=current_app.get_send_file_max_age(filename)
+    )
+
+
+manual_manifest = ManualManifest(os.path.join(os.path.dirname(__file__), "static"))
+
+
+@route("/favicon.ico")
 def favicon():
     return send_from_directory(
-        os.path.join(app.root_path, "static/images"),
+        os.path.join(current_app.root_path, "static/images"),
         "favicon.ico",
         mimetype="image/vnd.microsoft.icon",
     )
 
 
-@app.route("/downloads/<path:filename>")
+@route("/downloads/<path:filename>")
 def downloads(filename):
     downloads_path = os.environ.get("DOWNLOADS_PATH", "/data/www/subsurfacestaticsite/downloads")
     if not os.path.isabs(downloads_path):
-        downloads_path = os.path.join(app.root_path, downloads_path)
+        downloads_path = os.path.join(current_app.root_path, downloads_path)
 
     # Validate path to prevent directory traversal attacks
     requested_file = os.path.normpath(os.path.join(downloads_path, filename))
@@ -249,208 +194,300 @@ def downloads(filename):
         mime_type = "application/vnd.android.package-archive"
     elif filename.endswith(".AppImage"):
         mime_type = "application/vnd.appimage"
-    return send_from_directory(downloads_path, filename, mimetype=mime_type)
 
+    # the binaries are hundreds of MB - if the front proxy can deliver them itself,
+    # hand the transfer off instead of tying up a worker for the whole download
+    # DOWNLOADS_DELIVERY=x-accel-redirect: nginx, serving DOWNLOADS_ACCEL_PREFIX as an internal location
+    # DOWNLOADS_DELIVERY=x-sendfile: Apache mod_xsendfile / lighttpd
+    delivery = os.environ.get("DOWNLOADS_DELIVERY", "").strip().lower()
+    if delivery in ("x-accel-redirect", "x-sendfile"):
+        if not os.path.isfile(requested_file):
+            raise NotFound()
+        response = current_app.response_class(mimetype=mime_type)
+        if delivery == "x-accel-redirect":
+            prefix = os.environ.get("DOWNLOADS_ACCEL_PREFIX", "/internal-downloads/")
+            response.headers["X-Accel-Redirect"] = f"{prefix.rstrip('/')}/{quote(os.path.relpath(requested_file, normalized_downloads_path))}"
+        else:
+            response.headers["X-Sendfile"] = requested_file
+        return response
 
-@app.route("/subsurface-mobile-v3-user-manual/mobile-images/<path:path>")
-@app.route("/subsurface-mobile-user-manual/mobile-images/<path:path>")
-def mobile_user_manual_images(path):
-    return send_from_directory(os.path.join(app.root_path, "static/mobile-images"), path)
+    response = send_from_directory(downloads_path, filename, mimetype=mime_type)
+    # Werkzeug handles Range / If-Range for us, but wraps partial content in an iterator,
+    # which keeps gunicorn from using sendfile(); hand it a file wrapper positioned at the
+    # start of the range instead - gunicorn (unlike other servers) limits the transfer
+    # to the Content-Length of the response
+    file_wrapper = request.environ.get("wsgi.file_wrapper")
+    gunicorn = request.environ.get("SERVER_SOFTWARE", "").startswith("gunicorn")
+    if response.status_code == 206 and gunicorn and file_wrapper and response.content_range:
+        if hasattr(response.response, "close"):
+            response.response.close()
+        f = open(requested_file, "rb")
+        f.seek(response.content_range.start)
+        response.response = file_wrapper(f)
+        response.direct_passthrough = True
+    return response
 
 
-def _serve_user_manual(base_filename):
-    language = resolve_language(request.args.get("lang"))
-    if not language:
-        language = resolve_language(request.cookies.get("lang"))
-    if not language:
-        language = resolve_language(request.accept_languages.best_match(languages))
-    static_dir = os.path.join(app.root_path, "static")
+@route("/subsurface-mobile-v3-user-manual/mobile-images/<path:path>")
+@route("/subsurface-mobile-user-manual/mobile-images/<path:path>")
+def mobile_user_manual_images(path):
+    return manual_manifest.send_file(f"mobile-images/{path}")
 
-    if language and language[:2].isalpha():
-        file_name = f"{base_filename}_{language[:2]}.html"
-        file_path = os.path.join(static_dir, file_name)
-        if os.path.exists(file_path):
-            return send_from_directory(static_dir, file_name)
 
-    return send_from_directory(static_dir, f"{base_filename}.html")
+def _serve_user_manual(base_filename):
+    return manual_manifest.send_manual(base_filename, get_locale())
 
 
-@app.route("/subsurface-user-manual/")
+@route("/subsurface-user-manual/")
 def static_user_manual():
     return _serve_user_manual("user-manual")
 
 
-@app.route("/subsurface-mobile-v3-user-manual/")
-@app.route("/subsurface-mobile-user-manual/")
+@route("/subsurface-mobile-v3-user-manual/")
+@route("/subsurface-mobile-user-manual/")
 def static_mobile_user_manual():
     return _serve_user_manual("mobile-user-manual")
 
 
-@app.route("/subsurface-user-manual/images/<path:path>")
+@route("/subsurface-user-manual/images/<path:path>")
 def user_manual_images(path):
-    return send_from_directory(os.path.join(app.root_path, "static/images"), path)
+    return manual_manifest.send_file(f"images/{path}")
 
 
-@app.route("/release-changes/")
+@route("/release-changes/")
+@cached_page
 def release_changes():
     return render_template("release-changes.html", request=request)
 
 
-@app.get("/")
+@route("/", methods=["GET"])
+@cached_page
 def home():
     return render_template("home.html", request=request)
 
 
-@app.get("/latest-release/")
+@route("/latest-release/", methods=["GET"])
+@cached_page
 def latest_release():
     # print(f"request for latest-release with lrelease {env['lrelease'].value}")
     return render_template("latest-release.html", request=request)
 
 
-@app.get("/current-release/")
+@route("/current-release/", methods=["GET"])
+@cached_page
 def current_release():
     return render_template("current-release.html", request=request)
 
 
-@app.get("/user-forum/")
+@route("/user-forum/", methods=["GET"])
+@cached_page
 def user_forum():
     return render_template("user-forum.html", request=request)
 
 
-@app.get("/contribute/")
+@route("/contribute/", methods=["GET"])
+@cached_page
 def contribute():
     return render_template("contribute.html", request=request)
 
 
-@app.get("/bugtracker/")
+@route("/bugtracker/", methods=["GET"])
+@cached_page
 def bugtracker():
     return render_template("bugtracker.html", request=request)
 
 
-@app.get("/privacy-policy/")
+@route("/privacy-policy/", methods=["GET"])
+@cached_page
 def privacy_policy():
     return render_template("privacy-policy.html", request=request)
 
 
-@app.get("/faq/")
+@route("/faq/", methods=["GET"])
+@cached_page
 def faq():
     return render_template("faq.html", request=request)
 
 
-@app.get("/thanks/")
+@route("/thanks/", methods=["GET"])
+@cached_page
 def thanks():
     print("got a request for thanks")
     return render_template("thanks.html", request=request)
 
 
-@app.get("/credits/")
+@route("/credits/", methods=["GET"])
+@cached_page
 def credits():
     return render_template("credits.html", request=request)
 
 
-@app.get("/sponsoring/")
+@route("/sponsoring/", methods=["GET"])
+@cached_page
 def sponsoring():
     return render_template("sponsoring.html", request=request)
 
 
-@app.get("/documentation/")
+@route("/documentation/", methods=["GET"])
+@cached_page
 def documentation():
     return render_template("documentation.html", request=request)
 
 
-@app.get("/supported-dive-computers/")
+@route("/supported-dive-computers/", methods=["GET"])
+@cached_page
 def supported_dive_computers():
     return render_template("supported-dive-computers.html", request=request)
 
 
-@app.get("/tutorial-video/")
+@route("/tutorial-video/", methods=["GET"])
+@cached_page
 def tutorial_video():
     return render_template("tutorial-video.html", request=request)
 
 
-@app.get("/data-deletion/")
+@route("/data-deletion/", methods=["GET"])
+@cached_page
 def data_deletion():
     return render_template("data-deletion.html", request=request)
 
 
-@app.get("/updatecheck.html")
-@app.get("/updatecheck.html/")
+@route("/updatecheck.html", methods=["GET"])
+@route("/updatecheck.html/", methods=["GET"])
 def updatecheck():
+    return _updatecheck_response(legacy=True)
+
+
+@route("/updatecheck2/", methods=["GET"])
+def updatecheck2():
+    # new version with json data being returned to the client - requires newer Subsurface version that can parse this
+    # this will be expanded to provide specific download links in the future.
+    return _updatecheck_response(legacy=False)
+
+
+# every desktop client asks on startup, so this is by far our busiest endpoint;
+# the answer only depends on the current release and the version string the client
+# sends, so remember the complete response for the most common combinations
+UPDATECHECK_MAX_AGE = 300
+
+
+def _updatecheck_response(legacy: bool):
+    current = env["crelease"].value
+    version = request.args.get("version", "")
+    status, mimetype, body, etag, label, outcome = _updatecheck_answer(legacy, current, version)
+    updatecheck_stats.record(request.args.get("os"), label, outcome, (current, env["lrelease"].value))
+
+    response = current_app.response_class(response=body, status=status, mimetype=mimetype)
+    if etag:
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = f"public, max-age={UPDATECHECK_MAX_AGE}"
+        return response.make_conditional(request)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+@lru_cache(maxsize=256)
+def _parse_version(v: str):
     # semver makes this easy - but for the build-extra text to be handled correctly, it needs to be separated with a '+'
-    uv = request.args.get("version")
-    uv = request.args.get("version", "").replace("-", "+", 1)
-    if not Version.is_valid(uv):
-        print(f"{uv} is not a semVer - let's try something else")
+    v = v.replace("-", "+", 1)
+    if not Version.is_valid(v):
+        return None
+    return Version.parse(v)
+
+
+@lru_cache(maxsize=4096)
+def _parse_legacy_version(v: str):
+    user_version = _parse_version(v)
+    if user_version is None:
         # so this could be an old 4 part version number like 5.0.10.0
+        uv = v.replace("-", "+", 1)
         last_dot = uv.rfind(".")
         if last_dot > 4:
             uv = uv[:last_dot] + "+" + uv[last_dot + 1 :]
             print(f"rewrote version as {uv}")
+            if Version.is_valid(uv):
+                user_version = Version.parse(uv)
         else:
             print(f"cannot parse version {uv} - last_dot was {last_dot}")
-            return f"System error: cannot parse version {uv}"
-    user_version = Version.parse(uv)
+    return user_version
 
-    # and before we do anything else, parse the current version as well (with the same modification)
-    cv = env.get("crelease").value.replace("-", "+", 1)
-    if not Version.is_valid(cv):
-        print(f"cannot parse internal current version {cv}")
-        return "System error: cannot retrieve current version"
-    current_version = Version.parse(cv)
 
-    os = request.args.get("os")
-    user_agent = request.headers.get("User-Agent")
-    print(f"got a request for {os}, {user_version}, {user_agent}")
+@lru_cache(maxsize=4096)
+def _updatecheck_answer(legacy: bool, current: str, version: str):
+    # returns status, mimetype, body and ETag of the response, plus the version and outcome for the stats
+    uv = version.replace("-", "+", 1)
+    if legacy:
+        user_version = _parse_legacy_version(version)
+        if user_version is None:
+            return 200, "text/html", f"System error: cannot parse version {uv}", None, "invalid", "invalid"
+    else:
+        user_version = _parse_version(version)
+        if user_version is None:
+            print(f"cannot parse version {uv}")
+            return 400, "application/json", json.dumps({"err": f"System error: cannot parse version {uv}"}), None, "invalid", "invalid"
+
+    # parse the current version as well (with the same modification)
+    current_version = _parse_version(current or "")
+    if current_version is None:
+        print(f"cannot parse internal current version {current}")
+        label = str(user_version)
+        if legacy:
+            return 200, "text/html", "System error: cannot retrieve current version", None, label, "error"
+        err = json.dumps({"err": "System error: cannot retrieve current version"})
+        return 500, "application/json", err, None, label, "error"
 
     analysis = version_check(current_version, user_version)
-    ret = analysis.get("ret")
-    print(f"returning: {ret}")
-    return ret
+    if legacy:
+        mimetype, body = "text/html", analysis.get("ret")
+    else:
+        mimetype, body = "application/json", json.dumps(analysis)
+    etag = hashlib.sha1(f"{current}\0{body}".encode("utf-8")).hexdigest()
+    return 200, mimetype, body, etag, str(user_version), version_outcome(current_version, user_version)
 
 
-@app.get("/updatecheck2/")
-def updatecheck2():
-    # new version with json data being returned to the client - requires newer Subsurface version that can parse this
-    # this will be expanded to provide specific download links in the future.
-    # semver makes this easy - but for the build-extra text to be handled correctly, it needs to be separated with a '+'
-    uv = request.args.get("version", "").replace("-", "+", 1)
-    if not Version.is_valid(uv):
-        print(f"cannot parse version {uv}")
-        return {"err": f"System error: cannot parse version {uv}"}, 400
-    user_version = Version.parse(uv)
+@route("/api/updatecheck-stats", methods=["GET"])
+def updatecheck_stats_summary():
+    return current_app.response_class(
+        response=json.dumps(updatecheck_stats.summary()), status=200, mimetype="application/json"
+    )
 
-    # and before we do anything else, parse the current version as well (with the same modification)
-    cv = env.get("crelease").value.replace("-", "+", 1)
-    if not Version.is_valid(cv):
-        print(f"cannot parse internal current version {cv}")
-        return {"err": "System error: cannot retrieve current version"}, 500
-    current_version = Version.parse(cv)
 
-    os = request.args.get("os")
-    user_agent = request.headers.get("User-Agent")
-    print(f"got a request for {os}, {user_version}, {user_agent}")
+# per-worker numbers are summed up in Redis, so it doesn't matter which worker answers;
+# set METRICS_TOKEN to only answer scrapers that send it as a bearer token
+@route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    token = os.environ.get("METRICS_TOKEN", "").strip()
+    if token and not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        raise Forbidden()
+    return current_app.response_class(response=metrics.render(), status=200, mimetype="text/plain; version=0.0.4")
 
-    ret = version_check(current_version, user_version)
-    print(f"returning: {ret}")
-    return ret
+
+def version_outcome(current_version: Version, user_version: Version):
+    if current_version < user_version:
+        return "newer"
+    elif current_version == user_version:
+        return "ok" if user_version.build == "CICD-release" else "local"
+    elif current_version > user_version:
+        return "outdated" if user_version.build == "CICD-release" or user_version.build == "0" else "outdated-local"
+    return "error"
 
 
 def version_check(current_version: Version, user_version: Version):
     ret = "Server error"
     link = ""
-    if current_version < user_version:
+    outcome = version_outcome(current_version, user_version)
+    if outcome == "newer":
         ret = "You are running a build that is newer than the current release."
-    elif current_version == user_version:
-        if user_version.build == "CICD-release":
-            ret = "OK"
-        else:
-            ret = "You are running a local build that is based on the current release"
-    elif current_version > user_version:
+    elif outcome == "ok":
+        ret = "OK"
+    elif outcome == "local":
+        ret = "You are running a local build that is based on the current release"
+    elif outcome == "outdated":
         link = "https://subsurface-divelog.org/current-release/"
-        if user_version.build == "CICD-release" or user_version.build == "0":
-            ret = f"There is a newer release {current_version} available at {link}"
-        else:
-            ret = f"You appear to be running a local build that is based on an older release. Please upgrade to {current_version} at {link}"
+        ret = f"There is a newer release {current_version} available at {link}"
+    elif outcome == "outdated-local":
+        link = "https://subsurface-divelog.org/current-release/"
+        ret = f"You appear to be running a local build that is based on an older release. Please upgrade to {current_version} at {link}"
     else:
         print(f"semver comparison is broken for {current_version} and {user_version}")
     return {"ret": ret, "link": link}
@@ -475,75 +512,151 @@ def verifySignature():
     return hmac.compare_digest(signature, request.headers.get("X-Hub-Signature-256"))
 
 
-@app.route("/subsurface-release-webhook", methods=["POST"])
+@route("/subsurface-release-webhook", methods=["POST"])
 def webhook():
     print("webhook")
     if not verifySignature():
-        response = app.response_class(
+        response = current_app.response_class(
             response=json.dumps({"success": False}),
             status=403,
             mimetype="application/json",
         )
         return response
-    release_ids = env["release_ids"].value or []
-    body = request.data
-    with open("/var/log/webhook-requests.log", "a") as logfile:
-        print(body, file=logfile)
-    data = json.loads(body)
-    action = data.get("action", "")
-    if action == "":
-        print(f"got webhook call without action, bailing")
-        return app.response_class(response=json.dumps({"success": False}), status=500, mimetype="application/json")
-    release = data.get("release")
-    name = data.get("repository", {}).get("full_name", "missing repository.full_name")
-    if release:
-        release_id = release.get("id", "no release.id")
-        assets_url = release.get("assets_url", "no release.assets_url")
-        print(
-            f"Relase: '{release.get('name','no release name')}' id '{release_id}' from repo '{name}' with action '{action}' and assets URL {assets_url}"
-        )
-        if action == "released" and release_id not in release_ids:
-            release_ids.append(release_id)
-            env["release_ids"].value = release_ids
-            a = AssetDownloader(release_id, 120)
-    else:
-        print(f"got webhook call without release data - odd")
-    # in any case, report success
-    response = app.response_class(response=json.dumps({"success": True}), status=200, mimetype="application/json")
+    # the event is processed in the background - see webhooks.py
+    webhook_events.add(request.data, request.headers.get("X-GitHub-Delivery"))
+    response = current_app.response_class(response=json.dumps({"success": True}), status=202, mimetype="application/json")
     return response
 
 
-@app.route("/api/build-nr-by-sha/<sha>")
+# the supported dive computers page only ships a search field and asks this for
+# the vendors, the models of a vendor, search results or completions
+DIVECOMPUTER_MAX_AGE = 300
+
+
+@route("/api/divecomputers", methods=["GET"])
+def divecomputers_api():
+    q = request.args.get("q", "").strip()[:100]
+    vendor = request.args.get("vendor", "")
+    prefix = request.args.get("prefix", "").strip()[:100]
+    transport = request.args.get("transport") or None
+    if prefix:
+        answer = {"completions": dive_computers.complete(prefix)}
+    elif vendor:
+        answer = {"results": dive_computers.vendor(vendor, transport)}
+    elif q:
+        answer = {"results": dive_computers.search(q, transport)}
+    else:
+        answer = {"vendors": dive_computers.vendors()}
+    answer["success"] = True
+    response = current_app.response_class(response=json.dumps(answer), status=200, mimetype="application/json")
+    response.cache_control.public = True
+    response.cache_control.max_age = DIVECOMPUTER_MAX_AGE
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+@route("/api/build-nr-by-sha/<sha>")
 def build_nr_by_sha(sha):
     if not re.match(r"^[a-fA-F0-9]+$", sha):
-        return app.response_class(response=json.dumps({"success": False}), status=400, mimetype="application/json")
-    bnr = redis.get(f"bnr_{sha}")
-    if not bnr:
-        bnr = globals["nightlybuilds"].get_buildnr_for_sha(sha)
-        redis.set(f"bnr_{sha}", bnr)
-    else:
-        bnr = bnr.decode("utf-8")
-    redis.set(f"sha_{sha}", bnr)
-    response = app.response_class(
+        return current_app.response_class(response=json.dumps({"success": False}), status=400, mimetype="application/json")
+    bnr = globals["nightlybuilds"].get_buildnr_for_sha(sha)
+    response = current_app.response_class(
         response=json.dumps({"build_nr": bnr, "success": True}), status=200, mimetype="application/json"
     )
     return response
 
 
-@app.route("/api/sha-by-build-nr/<build_nr>")
+@route("/api/sha-by-build-nr/<build_nr>")
 def sha_by_build_nr(build_nr):
     if not re.match(r"^\d+$", build_nr):
-        return app.response_class(response=json.dumps({"success": False}), status=400, mimetype="application/json")
-
-    sha = redis.get(f"sha_{build_nr}")
-    if not sha:
-        sha = globals["nightlybuilds"].get_sha_for_buildnr(build_nr)
-        redis.set(f"sha_{build_nr}", sha)
-    else:
-        sha = sha.decode("utf-8")
-    response = app.response_class(response=json.dumps({"sha": sha, "success": True}), status=200, mimetype="application/json")
+        return current_app.response_class(response=json.dumps({"success": False}), status=400, mimetype="application/json")
+    sha = globals["nightlybuilds"].get_sha_for_buildnr(build_nr)
+    response = current_app.response_class(response=json.dumps({"sha": sha, "success": True}), status=200, mimetype="application/json")
     return response
 
 
+# resolve many SHAs and / or build numbers in one request:
+# POST {"shas": [...], "build_nrs": [...]} -> {"build_nrs": {sha: build_nr}, "shas": {build_nr: sha}}
+MAX_BATCH_LOOKUPS = 100
+
+
+def _is_build_nr(b):
+    # build numbers may be sent as numbers or strings - but not as true / false
+    if isinstance(b, bool):
+        return False
+    return (isinstance(b, int) and b >= 0) or (isinstance(b, str) and re.match(r"^\d+$", b) is not None)
+
+
+def _batch_error(err: str):
+    return current_app.response_class(response=json.dumps({"success": False, "err": err}), status=400, mimetype="application/json")
+
+
+@route("/api/builds", methods=["POST"])
+def builds_batch():
+    data = request.get_json(silent=True)
+    if data is None:
+        data = {}
+    if not isinstance(data, dict):
+        return _batch_error("expected a JSON object")
+    shas = data.get("shas", [])
+    build_nrs = data.get("build_nrs", [])
+    if not isinstance(shas, list) or not isinstance(build_nrs, list):
+        return _batch_error("shas and build_nrs must be lists")
+    if len(shas) + len(build_nrs) > MAX_BATCH_LOOKUPS:
+        return _batch_error(f"at most {MAX_BATCH_LOOKUPS} lookups per request")
+    if not all(isinstance(s, str) and re.match(r"^[a-fA-F0-9]+$", s) for s in shas):
+        return _batch_error("shas must be hex strings")
+    if not all(_is_build_nr(b) for b in build_nrs):
+        return _batch_error("build_nrs must be numbers")
+    build_nrs = [str(b) for b in build_nrs]
+    bnrs, found_shas = globals["nightlybuilds"].get_builds(shas, build_nrs)
+    result = {
+        "build_nrs": {sha: bnr or "unknown" for sha, bnr in bnrs.items()},
+        "shas": {bnr: sha or "unknown" for bnr, sha in found_shas.items()},
+        "success": True,
+    }
+    return current_app.response_class(response=json.dumps(result), status=200, mimetype="application/json")
+
+
+def create_app():
+    app = Flask(__name__)
+    # the old multi-level URLs are redirected before they even reach Flask's routing
+    app.wsgi_app = LegacyRedirects(app.wsgi_app)
+    Babel(app, locale_selector=get_locale)
+    app.before_request(start_request_timer)
+    app.before_request(pin_env_snapshot)
+    app.before_request(persist_language_and_clean_url)
+    app.after_request(record_response)
+    app.teardown_request(record_request)
+    app.teardown_request(unpin_env_snapshot)
+    before_render_template.connect(template_started, app)
+    template_rendered.connect(template_finished, app)
+    app.context_processor(utility_processor)
+    for rule, view, options in routes:
+        app.add_url_rule(rule, view_func=view, **options)
+    # serve the precompressed variants of our static assets where we have them
+    app.view_functions["static"] = static_precompressed
+    warm_up(app)
+    globals["app"] = app
+    return app
+
+
+# when gunicorn preloads the app, everything loaded here is shared by all workers
+def warm_up(app):
+    for name in app.jinja_env.list_templates():
+        try:
+            app.jinja_env.get_template(name)
+        except Exception as e:
+            print(f"cannot compile template {name}: {e}")
+    with app.test_request_context():
+        for language in languages:
+            with force_locale(language):
+                get_translations()
+
+
 if __name__ == "__main__":
+    from .maintenance import init_worker
+
+    app = create_app()
+    init_worker()
     app.run(host="0.0.0.0", port="8002", debug=True)
@@ -0,0 +1,51 @@
+import json
+import time
+import uuid
+
+from .redis import redis
+
+# Make sure that an expensive computation (git pull and friends) runs in only one
+# worker at a time: the first caller takes a lock in Redis and publishes its result,
+# everybody else asking for the same key in the meantime just waits for that result.
+# Results are kept for ttl seconds - negative results usually only for a short time,
+# so they get resolved once the data shows up.
+_release = redis.register_script(
+    """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+)
+
+POLL_INTERVAL = 0.05
+
+
+def single_flight(key: str, compute, ttl: int = 60, negative=None, negative_ttl: int = 300, timeout: int = 120):
+    result_key = f"sf_result_{key}"
+    lock_key = f"sf_lock_{key}"
+    cached = redis.get(result_key)
+    if cached is not None:
+        return json.loads(cached)
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + timeout
+    while True:
+        if redis.set(lock_key, token, nx=True, ex=timeout):
+            try:
+                value = compute()
+                expire = negative_ttl if value == negative else ttl
+                if expire:
+                    redis.set(result_key, json.dumps(value), ex=expire)
+                return value
+            finally:
+                _release(keys=[lock_key], args=[token])
+        # somebody else is on it - wait for their answer
+        while redis.exists(lock_key):
+            if time.monotonic() > deadline:
+                print(f"timed out waiting for {key}, computing it myself")
+                return compute()
+            time.sleep(POLL_INTERVAL)
+        cached = redis.get(result_key)
+        if cached is not None:
+            return json.loads(cached)
+        # the other worker didn't leave a result (failed or ttl 0) - try to take over
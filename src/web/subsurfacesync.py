@@ -1,68 +1,203 @@
+import filecmp
+import hashlib
+import json
 import os
 import re
 import shutil
 import subprocess
+import tempfile
+import threading
+from .divecomputers import index_exists, update_index
+from .env import bump_generation
+from .filesync import TreeSync, swap_link
 from .globals import globals
+from .metrics import metrics
+from .precompressed import ENCODINGS, compress_file, compress_tree
+from .redis import redis
+from .singleflight import single_flight
+
+
+# The nightly-builds repo has a branch-for-<sha> for every Subsurface commit that
+# was built, with the build number in latest-subsurface-buildnumber. Rather than
+# asking git on every API request, keep an index of all of them in Redis hashes
+# (plus a sorted set of the SHAs for prefix lookups) and extend it after every pull.
+BNR_BY_SHA = "nightly_bnr_by_sha"
+SHA_BY_BNR = "nightly_sha_by_bnr"
+SHAS = "nightly_shas"
+# how long a finished pull satisfies other workers, and how long we believe that
+# an unknown SHA or build number really doesn't exist before pulling again
+SYNC_REUSE = 10
+UNKNOWN_TTL = 300
+
+
+def _run(label, args, **kwargs):
+    # git, make and friends are where the time goes - keep track of it in /metrics
+    with metrics.timer("website_subprocess_seconds", command=label):
+        return subprocess.run(args, **kwargs)
 
 
 class NightlyBuilds:
     def __init__(self) -> None:
         self._myroot = globals["app_path"]
+        self._repo = f"{self._myroot}/subsurface/nightly-builds"
+
+    def _git(self, *args, input=None):
+        return _run(
+            f"git {args[0]}", ["git", "-C", self._repo, *args], input=input, stdout=subprocess.PIPE, check=True
+        ).stdout
 
     def sync(self):
+        # concurrent pulls in the same repo would just trip over each other's locks;
+        # a pull that finished a few seconds ago is as good as a new one
+        return single_flight("nightly_sync", self._sync, ttl=SYNC_REUSE)
+
+    def _sync(self):
         try:
-            subprocess.run(f"cd {self._myroot}/subsurface/nightly-builds; git pull", shell=True, check=True)
-        except subprocess.CalledProcessError:
+            self._git("pull")
+        except (subprocess.CalledProcessError, FileNotFoundError):
             print("issue pulling the latest nightly builds repo - please check")
+        return self.update_index()
 
-    def get_buildnr_for_sha(self, sha):
-        self.sync()
+    def update_index(self):
         try:
-            result = subprocess.run(
-                f"cd {self._myroot}/subsurface/nightly-builds; git diff origin/branch-for-{sha} latest-subsurface-buildnumber",
-                shell=True,
-                stdout=subprocess.PIPE,
-                check=True,
-            )
+            refs = self._git("for-each-ref", "--format=%(refname:short)", "refs/remotes/origin/branch-for-*")
+        except (subprocess.CalledProcessError, FileNotFoundError):
+            print("cannot list the branches of the nightly builds repo - please check")
+            return 0
+        known = {sha.decode("utf-8") for sha in redis.hkeys(BNR_BY_SHA)}
+        new_refs = {}
+        for ref in refs.decode("utf-8").split():
+            sha = ref.rpartition("branch-for-")[2].lower()
+            if re.match(r"^[a-f0-9]+$", sha) and sha not in known:
+                new_refs[sha] = ref
+        if not new_refs:
+            return 0
+        # read all the build numbers with a single git process
+        shas = list(new_refs.keys())
+        batch = "".join(f"{new_refs[sha]}:latest-subsurface-buildnumber\n" for sha in shas).encode("utf-8")
+        try:
+            output = self._git("cat-file", "--batch", input=batch)
         except subprocess.CalledProcessError:
-            # that sha doesn't exist
-            return "unknown"
-        output = result.stdout.decode("utf-8").strip()
-        bnr = open(f"{self._myroot}/subsurface/nightly-builds/latest-subsurface-buildnumber", "r").read().strip()
-        if output:
-            m = re.match(r"^-(\d+)", output)
-            if m:
-                bnr = m.group(1).strip()
+            print("cannot read the build numbers from the nightly builds repo - please check")
+            return 0
+        bnr_by_sha = {}
+        pos = 0
+        for sha in shas:
+            eol = output.index(b"\n", pos)
+            header = output[pos:eol].split()
+            pos = eol + 1
+            if header[-1] in (b"missing", b"ambiguous"):
+                continue
+            size = int(header[2])
+            bnr = output[pos : pos + size].decode("utf-8").strip()
+            pos += size + 1
+            if bnr.isdigit():
+                bnr_by_sha[sha] = bnr
+        if bnr_by_sha:
+            pipe = redis.pipeline()
+            pipe.hset(BNR_BY_SHA, mapping=bnr_by_sha)
+            pipe.hset(SHA_BY_BNR, mapping={bnr: sha for sha, bnr in bnr_by_sha.items()})
+            pipe.zadd(SHAS, {sha: 0 for sha in bnr_by_sha})
+            pipe.execute()
+        print(f"added {len(bnr_by_sha)} builds to the nightly build index")
+        return len(bnr_by_sha)
+
+    def lookup_buildnr(self, sha):
+        # pure index lookup; sha can be an abbreviated SHA as long as it is unique
+        sha = sha.lower()
+        bnr = redis.hget(BNR_BY_SHA, sha)
+        if bnr is None and len(sha) < 40:
+            matches = redis.zrangebylex(SHAS, f"[{sha}", f"[{sha}\xff", start=0, num=2)
+            if len(matches) > 1:
+                return "ambiguous"
+            if matches:
+                bnr = redis.hget(BNR_BY_SHA, matches[0])
+        return bnr.decode("utf-8") if bnr is not None else None
+
+    def lookup_sha(self, bnr):
+        sha = redis.hget(SHA_BY_BNR, str(bnr))
+        return sha.decode("utf-8") if sha is not None else None
+
+    def get_buildnr_for_sha(self, sha):
+        bnr = self.lookup_buildnr(sha)
+        if bnr is None:
+            # a build we haven't seen yet - pull and extend the index (once, for all workers asking)
+            bnr = single_flight(
+                f"bnr_{sha.lower()}", lambda: self._find_buildnr(sha), negative="unknown", negative_ttl=UNKNOWN_TTL
+            )
         return bnr
 
+    def _find_buildnr(self, sha, sync=None):
+        (sync or self.sync)()
+        return self.lookup_buildnr(sha) or "unknown"
+
     def get_sha_for_buildnr(self, bnr):
-        self.sync()
-        try:
-            result = subprocess.run(
-                f"cd {self._myroot}/subsurface; bash ./scripts/get-changeset-id.sh {bnr}",
-                shell=True,
-                stdout=subprocess.PIPE,
-                check=True,
+        sha = self.lookup_sha(bnr)
+        if sha is None:
+            sha = single_flight(
+                f"sha_{bnr}", lambda: self._find_sha(bnr), negative="unknown", negative_ttl=UNKNOWN_TTL
             )
-        except subprocess.CalledProcessError:
-            # that buildnr doesn't exist
-            return "unknown"
-        output = result.stdout.decode("utf-8").strip()
-        if output:
-            return output
-        return "unknown"
+        return sha
+
+    def _find_sha(self, bnr, sync=None):
+        (sync or self.sync)()
+        sha = self.lookup_sha(bnr)
+        if sha is None:
+            # fall back to asking the Subsurface repo
+            try:
+                result = _run(
+                    "get-changeset-id.sh",
+                    ["bash", "./scripts/get-changeset-id.sh", str(bnr)],
+                    cwd=f"{self._myroot}/subsurface",
+                    stdout=subprocess.PIPE,
+                    check=True,
+                )
+            except (subprocess.CalledProcessError, FileNotFoundError):
+                # that buildnr doesn't exist
+                return "unknown"
+            sha = result.stdout.decode("utf-8").strip()
+        return sha or "unknown"
+
+    def get_builds(self, shas, bnrs):
+        # the batch version of the two lookups above: what the index doesn't know goes
+        # through the same single flight and negative cache, with one pull for all of them
+        bnr_by_sha = {sha: self.lookup_buildnr(sha) for sha in shas}
+        sha_by_bnr = {bnr: self.lookup_sha(bnr) for bnr in bnrs}
+        synced = []
+
+        def sync_once():
+            if not synced:
+                synced.append(self.sync())
+
+        for sha, bnr in bnr_by_sha.items():
+            if bnr is None:
+                bnr_by_sha[sha] = single_flight(
+                    f"bnr_{sha.lower()}",
+                    lambda: self._find_buildnr(sha, sync_once),
+                    negative="unknown",
+                    negative_ttl=UNKNOWN_TTL,
+                )
+        for bnr, sha in sha_by_bnr.items():
+            if sha is None:
+                sha_by_bnr[bnr] = single_flight(
+                    f"sha_{bnr}", lambda: self._find_sha(bnr, sync_once), negative="unknown", negative_ttl=UNKNOWN_TTL
+                )
+        return bnr_by_sha, sha_by_bnr
 
 
 class SubsurfaceSync:
     def __init__(self) -> None:
         self._myroot = globals["app_path"]
+        self._static = f"{self._myroot}/src/web/static"
+        self._lock = threading.Lock()
 
     def setup(self):
         if not os.path.isdir(f"{self._myroot}/subsurface"):
             # ok - this is a brand new setup. Weeee
             print(f"Initial setup - cloning Subsurface repo into {self._myroot}/subsurface")
             try:
-                subprocess.run(
+                _run(
+                    "git clone",
                     f"cd {self._myroot}; git clone --depth 10 https://github.com/subsurface/subsurface ; cd subsurface ; git clone https://github.com/subsurface/nightly-builds; git config --global --add safe.directory {self._myroot}/subsurface",
                     shell=True,
                     check=True,
@@ -75,43 +210,138 @@ class SubsurfaceSync:
                 )
 
     def sync(self):
+        if not self._lock.acquire(blocking=False):
+            print("a Subsurface sync is already running")
+            return
         try:
-            subprocess.run(f"cd {self._myroot}/subsurface; git pull", shell=True, check=True)
-        except subprocess.CalledProcessError:
+            self._sync()
+        finally:
+            self._lock.release()
+
+    def _sync(self):
+        try:
+            _run("git pull", ["git", "-C", f"{self._myroot}/subsurface", "pull"], check=True)
+        except (subprocess.CalledProcessError, FileNotFoundError):
             print("issue pulling the latest Subsurface sources - please check")
-        shutil.copy(
-            f"{self._myroot}/subsurface/SupportedDivecomputers.html",
-            f"{self._myroot}/src/web/templates/",
-        )
+        source = f"{self._myroot}/subsurface/SupportedDivecomputers.html"
+        target = f"{self._myroot}/src/web/templates/SupportedDivecomputers.html"
+        changed = os.path.isfile(source) and not (os.path.isfile(target) and filecmp.cmp(source, target, shallow=False))
+        if changed:
+            shutil.copy(source, target)
+        if os.path.isfile(target) and (changed or not index_exists()):
+            update_index(target)
+            # workers pick up the new index with the next generation
+            bump_generation()
+        self.build_documentation()
+        compress_tree(self._static, skip=("manuals",))
+
+    # Documentation/output/<file> is published as static/manuals/<name>, built from Documentation/<source>
+    MANUALS = {
+        "user-manual.html": ("user-manual.html", "user-manual.txt"),
+        "user-manual_de.html": ("user-manual_de.html", "user-manual_de.txt"),
+        "mobile-manual-v3.html": ("mobile-user-manual.html", "mobile-manual-v3.txt"),
+        "mobile-manual_de.html": ("mobile-user-manual_de.html", "mobile-manual_de.txt"),
+    }
+
+    def _documentation_sources(self):
+        # git already has a content hash for every file in the tree
+        try:
+            output = _run(
+                "git ls-tree",
+                ["git", "-C", f"{self._myroot}/subsurface", "ls-tree", "-r", "HEAD", "Documentation/"],
+                stdout=subprocess.PIPE,
+                check=True,
+            ).stdout.decode("utf-8")
+        except (subprocess.CalledProcessError, FileNotFoundError):
+            return None
+        sources = {}
+        for line in output.splitlines():
+            info, _, file_path = line.partition("\t")
+            sources[file_path[len("Documentation/") :]] = info.split()[2]
+        return sources
+
+    def _documentation_digests(self, sources):
+        # every manual depends on its own source and on everything that isn't the source
+        # of a manual (Makefile, images, stylesheets, ...)
+        manual_source = re.compile(r"^(user|mobile)-manual.*\.txt$")
+        shared = hashlib.sha256()
+        for p in sorted(sources):
+            if not manual_source.match(p):
+                shared.update(f"{p}\0{sources[p]}\n".encode("utf-8"))
+        shared = shared.hexdigest()
+        digests = {}
+        for output, (_, source) in self.MANUALS.items():
+            digests[output] = hashlib.sha256(f"{shared}\0{source}\0{sources.get(source, '')}".encode("utf-8")).hexdigest()
+        return shared, digests
+
+    def _published_manifest(self):
         try:
-            subprocess.run(
-                f"cd {self._myroot}/subsurface/Documentation; rm -rf output/images output/mobile-images; make output/user-manual.html output/user-manual_de.html output/mobile-manual-v3.html output/mobile-manual_de.html", shell=True, check=True
+            with open(f"{self._static}/manuals/manifest.json", "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def build_documentation(self):
+        sources = self._documentation_sources()
+        if sources is None:
+            print("cannot list the Subsurface documentation sources - please check")
+            return
+        shared, digests = self._documentation_digests(sources)
+        published = self._published_manifest()
+        output_dir = f"{self._myroot}/subsurface/Documentation/output"
+        stale = [
+            output
+            for output in self.MANUALS
+            if published.get("inputs", {}).get(output) != digests[output] or not os.path.isfile(f"{output_dir}/{output}")
+        ]
+        if not stale:
+            print("Subsurface documentation is unchanged")
+            return
+        print(f"rebuilding {', '.join(stale)}")
+        if published.get("shared") != shared:
+            shutil.rmtree(f"{output_dir}/images", ignore_errors=True)
+            shutil.rmtree(f"{output_dir}/mobile-images", ignore_errors=True)
+        try:
+            _run(
+                "make",
+                ["make"] + [f"output/{output}" for output in stale],
+                cwd=f"{self._myroot}/subsurface/Documentation",
+                check=True,
             )
-        except subprocess.CalledProcessError:
+        except (subprocess.CalledProcessError, FileNotFoundError):
             print("issue building the latest Subsurface documentation - please check")
-        shutil.copy(
-            f"{self._myroot}/subsurface/Documentation/output/user-manual.html",
-            f"{self._myroot}/src/web/static/user-manual.html",
-        )
-        shutil.copy(
-            f"{self._myroot}/subsurface/Documentation/output/user-manual_de.html",
-            f"{self._myroot}/src/web/static/user-manual_de.html",
-        )
-        shutil.copy(
-            f"{self._myroot}/subsurface/Documentation/output/mobile-manual-v3.html",
-            f"{self._myroot}/src/web/static/mobile-user-manual.html",
-        )
-        shutil.copy(
-            f"{self._myroot}/subsurface/Documentation/output/mobile-manual_de.html",
-            f"{self._myroot}/src/web/static/mobile-user-manual_de.html",
-        )
-        shutil.copytree(
-            f"{self._myroot}/subsurface/Documentation/output/images",
-            f"{self._myroot}/src/web/static/images",
-            dirs_exist_ok=True,
-        )
-        shutil.copytree(
-            f"{self._myroot}/subsurface/Documentation/output/mobile-images",
-            f"{self._myroot}/src/web/static/mobile-images",
-            dirs_exist_ok=True,
-        )
+            return
+        self._publish_documentation({"shared": shared, "inputs": digests})
+
+    def _publish_documentation(self, manifest):
+        # assemble a complete new copy next to the current one and then atomically point
+        # the static/manuals symlink at it - requests never see a half copied manual
+        output_dir = f"{self._myroot}/subsurface/Documentation/output"
+        published = f"{self._static}/manuals"
+        new_dir = tempfile.mkdtemp(prefix="manuals.", dir=self._static)
+        os.chmod(new_dir, 0o755)
+        previous_dir = os.path.realpath(published) if os.path.islink(published) else None
+        tree = TreeSync(new_dir, previous_dir, self._published_manifest().get("files"))
+        for output, (name, _) in self.MANUALS.items():
+            tree.add_file(f"{output_dir}/{output}", name)
+        for images in ("images", "mobile-images"):
+            if os.path.isdir(f"{output_dir}/{images}"):
+                tree.add_tree(f"{output_dir}/{images}", images)
+        report = tree.finish()
+        manuals = {}
+        for name, _ in self.MANUALS.values():
+            unchanged = previous_dir and name in report["unchanged"]
+            compress_file(f"{new_dir}/{name}", f"{previous_dir}/{name}" if unchanged else None)
+            tree.files[name]["encodings"] = [e for e, ext in ENCODINGS if os.path.isfile(f"{new_dir}/{name}{ext}")]
+            # user-manual_de.html is the German variant of the user-manual
+            base, _, language = name[: -len(".html")].partition("_")
+            manuals.setdefault(base, {})[language or "en"] = name
+        manifest["manuals"] = manuals
+        print(f"publishing the documentation: {tree.summary()}")
+        manifest["files"] = tree.files
+        manifest["changes"] = {k: v for k, v in report.items() if k != "unchanged"}
+        with open(f"{new_dir}/manifest.json", "w") as f:
+            json.dump(manifest, f)
+        swap_link(published, new_dir)
+        # let the workers know that there is a new manifest
+        bump_generation()
@@ -0,0 +1,90 @@
+import atexit
+import re
+import threading
+import time
+from collections import Counter
+
+from .redis import redis
+
+# os and version are whatever the client sends - only count the values we know about,
+# so nobody can add fields to the hash at will: the operating systems Subsurface sends
+# and the releases the website offers (the outcome says whether it was a release build)
+OPERATING_SYSTEMS = ("win", "mac", "linux", "android", "ios")
+VERSION_RE = re.compile(r"^(\d+)\.(\d+)\.(\d+)(?![\d.])")
+
+
+def os_label(os: str):
+    os = (os or "").lower()
+    if not os:
+        return "unknown"
+    return os if os in OPERATING_SYSTEMS else "other"
+
+
+def _release(version: str):
+    m = VERSION_RE.match(version or "")
+    return ".".join(str(int(part)) for part in m.groups()) if m else None
+
+
+def version_label(version: str, releases=()):
+    if version == "invalid":
+        return version
+    release = _release(version)
+    return release if release and release in {_release(r) for r in releases} else "other"
+
+
+# Count update checks per (os, version, outcome) in memory and add the counts to
+# a Redis hash every few seconds, instead of printing every single request
+class UpdateCheckStats:
+    def __init__(self, key: str = "updatecheck_stats", interval: float = 10):
+        self._key = key
+        self._interval = interval
+        self._counts = Counter()
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+    def record(self, os: str, version: str, outcome: str, releases=()):
+        # releases are the versions the website currently offers
+        os = os_label(os)
+        version = version_label(version, releases)
+        with self._lock:
+            self._counts[(os, version, outcome)] += 1
+        if time.monotonic() - self._last_flush >= self._interval:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            counts, self._counts = self._counts, Counter()
+            self._last_flush = time.monotonic()
+        if not counts:
+            return
+        try:
+            pipe = redis.pipeline(transaction=False)
+            for (os, version, outcome), n in counts.items():
+                pipe.hincrby(self._key, f"{os}|{version}|{outcome}", n)
+            pipe.execute()
+        except Exception as e:
+            print(f"failed to flush update check stats: {e}")
+
+    def summary(self):
+        self.flush()
+        by_os = Counter()
+        by_version = Counter()
+        by_outcome = Counter()
+        total = 0
+        for field, n in redis.hgetall(self._key).items():
+            os, version, outcome = field.decode("utf-8").rsplit("|", 2)
+            n = int(n)
+            by_os[os] += n
+            by_version[version] += n
+            by_outcome[outcome] += n
+            total += n
+        return {
+            "total": total,
+            "os": dict(by_os.most_common()),
+            "version": dict(by_version.most_common()),
+            "outcome": dict(by_outcome.most_common()),
+        }
+
+
+updatecheck_stats = UpdateCheckStats()
+atexit.register(updatecheck_stats.flush)
@@ -0,0 +1,150 @@
+import json
+import threading
+
+from redis.exceptions import ResponseError
+
+from .assetdownloader import schedule_release_check
+from .env import env
+from .metrics import metrics
+from .redis import redis
+
+# The webhook only verifies the signature and adds the event to a Redis stream, so
+# GitHub gets its answer right away no matter what else is going on. GitHub retries
+# deliveries it isn't sure about - we remember the delivery IDs for a week and
+# drop the duplicates. A single consumer (in the leader) works through the stream in
+# order; events are only acknowledged once they have been processed, so whatever was
+# left over when that worker went away is picked up again. An event that fails (Redis
+# hiccup, ...) stays pending and is tried again a few seconds later; after
+# MAX_ATTEMPTS it is moved to the WEBHOOK_DEAD stream. Events we can't even parse are
+# dropped right away - trying them again won't help.
+WEBHOOK_STREAM = "webhook_events"
+WEBHOOK_DEAD = "webhook_events_dead"
+WEBHOOK_ATTEMPTS = "webhook_attempts"
+WEBHOOK_GROUP = "website"
+WEBHOOK_LOG = "/var/log/webhook-requests.log"
+DELIVERY_TTL = 7 * 24 * 60 * 60
+STREAM_MAXLEN = 10000
+BLOCK_MS = 5000
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 5
+
+
+def process_webhook(body: bytes):
+    try:
+        with open(WEBHOOK_LOG, "a") as logfile:
+            print(body, file=logfile)
+    except OSError as e:
+        print(f"cannot log webhook request: {e}")
+    data = json.loads(body)
+    action = data.get("action", "")
+    if action == "":
+        print(f"got webhook call without action, bailing")
+        return
+    release = data.get("release")
+    name = data.get("repository", {}).get("full_name", "missing repository.full_name")
+    if release:
+        release_id = release.get("id", "no release.id")
+        assets_url = release.get("assets_url", "no release.assets_url")
+        print(
+            f"Relase: '{release.get('name','no release name')}' id '{release_id}' from repo '{name}' with action '{action}' and assets URL {assets_url}"
+        )
+        if action == "released":
+            # both are no-ops for a release we already know about and are checking - so
+            # an event that failed half way through can simply be processed again
+            env["release_ids"].add(release_id)
+            schedule_release_check(release_id, 120)
+    else:
+        print(f"got webhook call without release data - odd")
+
+
+class WebhookEvents:
+    def __init__(self):
+        self._thread = None
+        self._stop = threading.Event()
+
+    def add(self, body: bytes, delivery: str = None):
+        # returns False for deliveries we have seen before
+        if delivery and not redis.set(f"webhook_delivery_{delivery}", "1", nx=True, ex=DELIVERY_TTL):
+            print(f"dropping duplicate webhook delivery {delivery}")
+            metrics.inc("website_webhook_events_total", outcome="duplicate")
+            return False
+        try:
+            redis.xadd(
+                WEBHOOK_STREAM, {"delivery": delivery or "", "body": body}, maxlen=STREAM_MAXLEN, approximate=True
+            )
+        except Exception:
+            # let GitHub's retry through
+            if delivery:
+                redis.delete(f"webhook_delivery_{delivery}")
+            raise
+        return True
+
+    def _read(self, last_id: str):
+        # "0" returns what we read before but never acknowledged, ">" waits for new events
+        answer = redis.xreadgroup(
+            WEBHOOK_GROUP, WEBHOOK_GROUP, {WEBHOOK_STREAM: last_id}, count=10, block=None if last_id == "0" else BLOCK_MS
+        )
+        return answer[0][1] if answer else []
+
+    def _run(self, stop: threading.Event):
+        try:
+            redis.xgroup_create(WEBHOOK_STREAM, WEBHOOK_GROUP, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        last_id = "0"
+        while not stop.is_set():
+            try:
+                events = self._read(last_id)
+                if not events and last_id == "0":
+                    last_id = ">"
+                for event_id, fields in events:
+                    if not self._process(event_id, fields):
+                        # leave it pending and start over with it after a moment
+                        last_id = "0"
+                        stop.wait(RETRY_DELAY)
+                        break
+            except Exception as e:
+                print(f"webhook consumer failed: {e}")
+                last_id = "0"
+                stop.wait(1)
+
+    def _process(self, event_id, fields):
+        # returns False if the event should be tried again
+        delivery = fields.get(b"delivery", b"").decode()
+        try:
+            process_webhook(fields[b"body"])
+            metrics.inc("website_webhook_events_total", outcome="processed")
+        except (ValueError, KeyError, AttributeError, TypeError) as e:
+            # not JSON (or not the JSON GitHub sends) - there is no point in trying again
+            metrics.inc("website_webhook_events_total", outcome="failed")
+            print(f"dropping broken webhook delivery {delivery}: {e}")
+        except Exception as e:
+            attempts = redis.hincrby(WEBHOOK_ATTEMPTS, event_id, 1)
+            if attempts < MAX_ATTEMPTS:
+                metrics.inc("website_webhook_events_total", outcome="retry")
+                print(f"failed to process webhook delivery {delivery} (attempt {attempts}), trying again: {e}")
+                return False
+            metrics.inc("website_webhook_events_total", outcome="dead")
+            print(f"giving up on webhook delivery {delivery} after {attempts} attempts: {e}")
+            redis.xadd(WEBHOOK_DEAD, {**fields, b"error": str(e)}, maxlen=STREAM_MAXLEN, approximate=True)
+        pipe = redis.pipeline()
+        pipe.xack(WEBHOOK_STREAM, WEBHOOK_GROUP, event_id)
+        pipe.hdel(WEBHOOK_ATTEMPTS, event_id)
+        pipe.execute()
+        return True
+
+    def start(self):
+        # like the job queue: a consumer that was stopped may still be blocked in XREADGROUP
+        # for a few seconds - it gets its own stop event, so starting again always works
+        if self._thread is not None and self._thread.is_alive() and not self._stop.is_set():
+            return
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(self._stop,), name="webhook-events", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+webhook_events = WebhookEvents()